@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+"""Benchmark of the Netszch csv parser against the old row-by-row loop.
+* Takes data file paths from the command line, or uses the two largest runs.
+* Prints rows/sec for the bulk reader in th_exp_parse and for the legacy loop.
+The legacy loop grew the dataframe by one row per data line with
+DataFrame.append, which current pandas no longer has; pd.concat is the
+same operation and is used in its place. It is quadratic, so by default
+it only gets the first legacy_rows data lines of each file.
+"""
+
+import csv
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from th_exp_parse import read_csv_export, csv_encoding
+
+default_files = ['data/14.1mm-083019/albAmel100r1-11.1mm-081219.csv',
+                 'data/14.1mm-083019/ExpDat_sapph14.1mm08302019.csv']
+# Number of data lines fed to the legacy loop.
+legacy_rows = 3000
+# Number of timed repeats for the bulk reader.
+repeats = 5
+
+
+def legacy_parse(path, max_rows):
+    """The old parse_file loop, stopping after max_rows data lines."""
+    with open(path, 'r', encoding=csv_encoding, errors='ignore') as raw_file:
+        raw_csv = csv.reader((line.replace('\0', '') for line in raw_file),
+                             skipinitialspace=True, delimiter=',')
+        raw_data = list(raw_csv)
+    metadata_text = []
+    metadata = True
+    rows = 0
+    for row in raw_data:
+        if len(row) == 0:
+            pass
+        elif row[0].startswith('##'):
+            metadata = False
+            row[0] = row[0][2:]
+            df = pd.DataFrame(columns=row[0:3])
+        elif metadata:
+            row[0] = row[0][1:]
+            metadata_text.append(row[0].strip()+' '+row[1].strip())
+        else:
+            newdata = np.array([float(row[0]), float(row[1]), float(row[2])])
+            newline = pd.DataFrame(newdata.reshape(1, 3), columns=df.columns)
+            df = pd.concat([df, newline])
+            rows += 1
+            if rows >= max_rows:
+                break
+    return df
+
+
+def time_bulk(path):
+    """Returns (rows, best seconds) for th_exp_parse.read_csv_export."""
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        metadata, df = read_csv_export(path)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(df), best
+
+
+def time_legacy(path, max_rows):
+    """Returns (rows, seconds) for the legacy loop."""
+    start = time.perf_counter()
+    df = legacy_parse(path, max_rows)
+    return len(df), time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or default_files
+    print(f"{'file':<40} {'parser':<7} {'rows':>7} {'seconds':>9} {'rows/sec':>11}")
+    for path in paths:
+        name = os.path.basename(path)
+        for label, (rows, seconds) in (('bulk', time_bulk(path)),
+                                       ('legacy', time_legacy(path, legacy_rows))):
+            print(f'{name:<40} {label:<7} {rows:>7} {seconds:>9.4f} {rows/seconds:>11.0f}')
@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+
+"""Benchmark suite for the processing pipeline on synthetic exports.
+* Writes synthetic Netszch exports (see synth_export) of each size, with a
+  sapphire standard, into a scratch data tree,
+* times each pipeline stage separately, best of a few repeats, then
+  runs it once more under tracemalloc for its peak memory,
+* prints a table, with --baseline compares the results against an
+  earlier results file, and then writes them to a JSON file, which must
+  not be the baseline.
+Stages:
+    parse         th_exp_fit.parse_file
+    calibration   certificate and standard fits and correction curves
+    process       th_exp_fit.process_file, csv and columnar outputs; the
+                  spline models only up to max_spline_rows rows
+    chunked       th_exp_fit.process_file in blocks of chunk_rows rows,
+                  polynomial models only
+    archive_json  th_exp_data_extractor.archive_data_file
+    archive_col   th_exp_data_extractor.archive_data_file, columnar
+    plot          plot_all.plot_sample of the processed run (csv only)
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repo_dir)
+from synth_export import write_export
+from th_exp_fit import check_update, load_calibration, parse_file, \
+    process_file, output_base_name
+from th_exp_calibration import load_registry, curve_cache, cert_file
+from th_exp_data_extractor import archive_data_file
+from data_fitting import fit_models
+from plot_all import plot_sample
+
+stages = ('parse', 'calibration', 'process', 'chunked', 'archive_json',
+          'archive_col', 'plot')
+csv_sizes = [1000, 10000, 100000, 1000000]
+# Writing and reading big workbooks is slow, so they stop sooner.
+xlsx_sizes = [1000, 10000, 100000]
+# Timed repeats per stage; fewer for big runs, so that no stage reads
+# much more than max_repeat_rows rows in all.
+repeats = 3
+max_repeat_rows = 1000000
+# The spline fits grow much faster than the row count (about 5 s each
+# at 50k rows), so bigger runs are processed with the polynomials only.
+# The largest real runs have about 20k rows.
+max_spline_rows = 20000
+# Block size of the chunked stage
+chunk_rows = 50000
+# Both output formats are written, as the stage descriptions say.
+all_formats = ('csv', 'col')
+results_file = os.path.join(repo_dir, 'benchmarks', 'pipeline_results.json')
+# Slowdown against the baseline that gets flagged
+regression_ratio = 1.2
+
+
+def make_folder(root, rows, export_format):
+    """Writes a sample run and a standard of the given size into a new
+    folder of the scratch tree. Returns the folder and the sample name.
+    """
+    folder = os.path.join(root, f'{export_format}{rows}', '')
+    os.makedirs(folder)
+    name = f'synth100r{rows}.{export_format}'
+    write_export(folder + name, rows)
+    write_export(folder + 'ExpDat_sapphsynth.' + export_format, rows,
+                 standard=True, seed=1)
+    return folder, name
+
+
+def calibrate(folder):
+    """Fits the certificate and standard from scratch and evaluates the
+    correction curves, as for a folder seen for the first time.
+    """
+    curve_cache.clear()
+    registry = load_registry(folder + '../')
+    manifest, stamps, depends, file_names = check_update(folder, registry)
+    return load_calibration(folder, file_names, depends, registry)[0]
+
+
+def stage_calls(folder, name, curves, plot_dir, models=fit_models):
+    """The call for each stage, on one sample file."""
+    run = 'r' + name.split('r')[-1].split('.')[0]
+    processed = output_base_name(name) + '.csv'
+    return {'parse': lambda: parse_file(folder, name),
+            'calibration': lambda: calibrate(folder),
+            'process': lambda: process_file(folder, name, curves,
+                                            all_formats, models),
+            'chunked': lambda: process_file(folder, name, curves,
+                                            all_formats, models,
+                                            chunk=chunk_rows),
+            'archive_json': lambda: archive_data_file(folder, name, 'json'),
+            'archive_col': lambda: archive_data_file(folder, name, 'col'),
+            'plot': lambda: plot_sample('synth', {'100': {run: processed}},
+                                        folder, plot_dir)}
+
+
+def measure(call, count):
+    """Best wall time of count calls, then the peak traced memory of one
+    more. The pipeline's progress printing is kept out of the way.
+    Returns seconds and peak megabytes.
+    """
+    best = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(count):
+            start = time.perf_counter()
+            call()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        tracemalloc.start()
+        try:
+            call()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak / 2**20
+
+
+def run_suite(sizes, export_formats, selected=stages, root=None):
+    """Runs the selected stages on every size of every export format.
+    Returns a list of result dictionaries.
+    """
+    results = []
+    scratch = tempfile.mkdtemp(prefix='th_exp_bench_') if root is None else root
+    try:
+        shutil.copy2(os.path.join(repo_dir, 'data', cert_file), scratch)
+        plot_dir = os.path.join(scratch, 'plots')
+        os.makedirs(plot_dir, exist_ok=True)
+        for export_format in export_formats:
+            for rows in sizes[export_format]:
+                folder, name = make_folder(scratch, rows, export_format)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    curves = calibrate(folder)
+                models = [m for m in fit_models
+                          if m.startswith('p') or rows <= max_spline_rows]
+                calls = stage_calls(folder, name, curves, plot_dir, models)
+                count = max(1, min(repeats, max_repeat_rows // rows))
+                for stage in selected:
+                    if stage == 'plot' and export_format != 'csv':
+                        continue
+                    if stage == 'plot' and 'process' not in selected:
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            calls['process']()
+                    seconds, peak_mb = measure(calls[stage], count)
+                    result = {'stage': stage, 'format': export_format,
+                              'rows': rows, 'seconds': seconds,
+                              'rows_per_sec': rows / seconds,
+                              'peak_mb': peak_mb}
+                    if stage in ('process', 'chunked'):
+                        result['models'] = models
+                    print_result(result)
+                    results.append(result)
+    finally:
+        if root is None:
+            shutil.rmtree(scratch)
+    return results
+
+
+def print_result(result, baseline=None):
+    """Prints one line of the results table."""
+    line = (f"{result['stage']:<13} {result['format']:<5} {result['rows']:>8} "
+            f"{result['seconds']:>9.4f} {result['rows_per_sec']:>11.0f} "
+            f"{result['peak_mb']:>8.1f}")
+    if baseline is not None:
+        ratio = result['seconds'] / baseline['seconds']
+        flag = '  slower' if ratio > regression_ratio else ''
+        line += f' {ratio:>7.2f}x{flag}'
+    print(line, flush=True)
+    return None
+
+
+def compare(results, baseline_path):
+    """Prints each result against the matching baseline result."""
+    with open(baseline_path, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    old = {(r['stage'], r['format'], r['rows']): r
+           for r in baseline['results']}
+    print(f"\nAgainst {baseline_path} ({baseline['created']}):")
+    for result in results:
+        key = (result['stage'], result['format'], result['rows'])
+        if key in old:
+            print_result(result, old[key])
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=csv_sizes,
+                        help='rows of the csv exports (default %(default)s)')
+    parser.add_argument('--xlsx-sizes', type=int, nargs='*', default=xlsx_sizes,
+                        help='rows of the xlsx exports (default %(default)s)')
+    parser.add_argument('--stages', nargs='+', choices=stages,
+                        default=list(stages), help='stages to run (default: all)')
+    parser.add_argument('--output', default=results_file,
+                        help='results file (default benchmarks/pipeline_results.json)')
+    parser.add_argument('--baseline', default=None,
+                        help='earlier results file to compare against')
+    args = parser.parse_args()
+    if args.baseline is not None and \
+            os.path.abspath(args.output) == os.path.abspath(args.baseline):
+        parser.error('--output would overwrite the --baseline results')
+    sizes = {'csv': args.sizes, 'xlsx': args.xlsx_sizes}
+    print(f"{'stage':<13} {'fmt':<5} {'rows':>8} {'seconds':>9} "
+          f"{'rows/sec':>11} {'peak MB':>8}")
+    results = run_suite(sizes, [f for f in ('csv', 'xlsx') if sizes[f]],
+                        args.stages)
+    record = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'numpy': np.__version__, 'pandas': pd.__version__,
+              'machine': platform.machine(), 'cpus': os.cpu_count(),
+              'results': results}
+    # The baseline is read before the new results are written.
+    if args.baseline is not None:
+        compare(results, args.baseline)
+    with open(args.output, 'w') as output_file:
+        json.dump(record, output_file, indent=1)
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+"""Generator of synthetic Netszch DIL 402C exports for the benchmarks.
+* Writes .csv exports as the instrument software does: an ISO-8859-15
+  metadata block padded with spaces, a blank line with a NUL byte, the
+  '##' column header line, and data lines with three digit exponents.
+* Writes .xlsx exports laid out like the ones Excel makes from those.
+* Makes sample runs and sapphire standards, which also carry the
+  'Segment' column, for a heating segment of any number of rows, or
+  with cooling for a heating and a cooling segment between them.
+The expansion is a smooth curve plus a shared instrument baseline and
+noise, so the corrections and fits have realistic work to do.
+Run directly to write a sample and a standard of the given size.
+"""
+
+import argparse
+import os
+import numpy as np
+
+csv_encoding = 'iso_8859_15'
+# Heating segment of the synthetic runs
+start_temp = 20.0
+end_temp = 1100.0
+heating_rate = 3.0
+# Cooling segment of the two segment runs
+cooling_rate = 10.0
+cool_temp = 300.0
+# Noise on dL/Lo and on the temperature
+length_noise = 5e-7
+temp_noise = 0.01
+
+
+def run_metadata(name, standard=False, length=10.0, cooling=False):
+    """Metadata pairs of a synthetic run, in the order of a real export."""
+    segment = f'{start_temp:.1f}°C/{heating_rate:.1f}(K/min)/{end_temp:.1f}°C'
+    segments = [('SEG. 1', segment)]
+    program = segment
+    numbers = 'S1/1'
+    if cooling:
+        second = f'{end_temp:.1f}°C/{cooling_rate:.1f}(K/min)/{cool_temp:.1f}°C'
+        segments.append(('SEG. 2', second))
+        program = segment + second[second.index('/'):] + '/'
+        numbers = 'S1-2/2'
+    return [('EXPORTTYPE', 'DATA ALL'),
+            ('FILE', name + '.ngb-sle'),
+            ('FORMAT', 'NETZSCH5'),
+            ('FTYPE', 'ANSI'),
+            ('IDENTITY', 'sapphire' if standard else name),
+            ('DECIMAL', 'POINT'),
+            ('SEPARATOR', 'COMMA'),
+            ('MTYPE', 'DIL'),
+            ('INSTRUMENT', 'NETZSCH DIL 402C'),
+            ('PROJECT', 'synthetic'),
+            ('DATE/TIME', '1/1/2020 9:00:00 AM (UTC-5)'),
+            ('CORR. FILE', ''),
+            ('TEMPCAL', 'TCALZERO.TMX'),
+            ('LABORATORY', 'Mineral Physics'),
+            ('OPERATOR', 'PAG'),
+            ('REMARK', 'synthetic run'),
+            ('SAMPLE', 'stnd saph' if standard else name),
+            ('SAMPLE LENGTH /mm', length),
+            ('MATERIAL', 'sapphire stnd'),
+            ('MEASMODE', 'Standard Expansion'),
+            ('PURGE GAS 1', 'ARGON'),
+            ('FLOW RATE 1 /(ml/min)', 75),
+            ('M.RANGE /µm', 500),
+            ('CORR. CODE', '010'),
+            ('RANGE', program),
+            ('SEGMENT', numbers)] + segments
+
+
+def run_data(rows, standard=False, seed=0, cooling=False):
+    """Temperature, time, dL/Lo and segment number columns of a synthetic
+    heating run, or heating and cooling run, sampled at even times.
+    Returns a float64 array of shape (rows, 4).
+    """
+    rng = np.random.default_rng(seed)
+    heat_time = (end_temp - start_temp)/heating_rate
+    if cooling:
+        total = heat_time + (end_temp - cool_temp)/cooling_rate
+    else:
+        total = heat_time
+    time = np.linspace(0.0, total, rows)
+    program = np.where(time <= heat_time, start_temp + heating_rate*time,
+                       end_temp - cooling_rate*(time - heat_time))
+    temp = program + rng.normal(0, temp_noise, rows)
+    dt = temp - start_temp
+    # The instrument baseline is common to samples and standards, which
+    # is what the standard correction takes out.
+    baseline = -2e-6*dt - 1.5e-9*dt**2
+    if standard:
+        expansion = 5.5e-6*dt + 2.0e-9*dt**2
+    else:
+        expansion = 7e-6*dt + 4e-9*dt**2 - 1.2e-12*dt**3
+    length = expansion + baseline + rng.normal(0, length_noise, rows)
+    segment = np.where(time <= heat_time, 1.0, 2.0)
+    return np.column_stack((temp, time, length, segment))
+
+
+def windows_exponent(text):
+    """Turns Python's two digit exponent into the export's three digits."""
+    return text[:-2] + '0' + text[-2:]
+
+
+def write_csv_export(path, rows, standard=False, seed=0, cooling=False):
+    """Writes a synthetic .csv export."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    data = run_data(rows, standard, seed, cooling)
+    columns = 'Temp./°C,Time/min,dL/Lo'
+    segment_format = ''
+    if standard or cooling:
+        columns += ',Segment'
+        segment_format = ',{:.0f}'
+    with open(path, 'w', encoding=csv_encoding) as export:
+        for key, value in run_metadata(name, standard, cooling=cooling):
+            export.write(f'#{key + ":":<22},{str(value):<40}\n')
+        # The blank line before the '##' line has a NUL byte in it.
+        export.write('\0\n')
+        export.write('##' + columns + '\n')
+        export.writelines(
+            f'{temp:10.5f},{time:9.5f},{windows_exponent(f"{length: .4e}")}'
+            + segment_format.format(segment) + '\n'
+            for temp, time, length, segment in data.tolist())
+    return None
+
+
+def write_xlsx_export(path, rows, standard=False, seed=0, cooling=False):
+    """Writes a synthetic .xlsx export, streaming the rows."""
+    import openpyxl as xlsx
+    name = os.path.splitext(os.path.basename(path))[0]
+    data = run_data(rows, standard, seed, cooling)
+    segments = data[:, 3].astype(int).tolist()
+    # Rounded as the instrument software writes them.
+    data = np.column_stack((data[:, 0].round(5), data[:, 1].round(5),
+                            [float(f'{length:.4e}') for length in data[:, 2]]))
+    workbook = xlsx.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for key, value in run_metadata(name, standard, cooling=cooling):
+        sheet.append([f'#{key + ":":<22}', value])
+    sheet.append([])
+    header = ['##Temp./°C', 'Time/min', 'dL/Lo']
+    if standard or cooling:
+        sheet.append(header + ['Segment'])
+        for row, segment in zip(data.tolist(), segments):
+            sheet.append(row + [segment])
+    else:
+        sheet.append(header)
+        for row in data.tolist():
+            sheet.append(row)
+    workbook.save(path)
+    return None
+
+
+def write_export(path, rows, standard=False, seed=0, cooling=False):
+    """Writes a synthetic export in the format of its extension."""
+    if path.endswith('.xlsx'):
+        return write_xlsx_export(path, rows, standard, seed, cooling)
+    return write_csv_export(path, rows, standard, seed, cooling)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', help='folder for the synthetic exports')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='data rows per export (default %(default)s)')
+    parser.add_argument('--format', choices=['csv', 'xlsx'], default='csv',
+                        help='export format (default %(default)s)')
+    args = parser.parse_args()
+    os.makedirs(args.folder, exist_ok=True)
+    write_export(os.path.join(args.folder, f'synth100r{args.rows}.{args.format}'),
+                 args.rows)
+    write_export(os.path.join(args.folder, f'ExpDat_sapphsynth.{args.format}'),
+                 args.rows, standard=True, seed=1)
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+
+"""Checks of the pipeline pieces the benchmarks lean on, on synthetic
+exports (see synth_export):
+* chunked processing gives the outputs and fits of whole-run processing,
+  for a two segment run and several block sizes,
+* rebase_poly_stats is an exact change of domain,
+* find_segments splits heating from cooling, with or without the
+  instrument's segment numbers, and block by block as a whole,
+* resample_run bins each segment on the grid in recording order.
+Run with python -m pytest benchmarks.
+"""
+
+import os
+import shutil
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repo_dir)
+from synth_export import write_export, run_data, run_metadata
+from th_exp_fit import check_update, load_calibration, process_file, \
+    resample_run
+from th_exp_calibration import load_registry, cert_file
+from th_exp_columnar import read_columns
+from th_exp_segments import find_segments, declared_segments, \
+    segment_state, update_segments, finish_segments
+from data_fitting import fit_models, poly_stats, update_poly_stats, \
+    rebase_poly_stats, poly_stats_fit
+
+# Rows of the synthetic two segment run; the cooling segment is about a
+# fifth of them.
+run_rows = 3000
+# Block sizes of the chunked runs: smaller than a rate window, a few
+# blocks, and the whole run in one block.
+chunk_sizes = [97, 1000, 100000]
+polynomial_models = [model for model in fit_models if model.startswith('p')]
+sample_name = 'synth100r1.csv'
+all_formats = ('csv', 'col')
+
+
+def segment_metadata():
+    """Metadata of a two segment run, keyed as the parser keys it."""
+    return {key + ':': value for key, value in run_metadata('synth',
+                                                            cooling=True)}
+
+
+@pytest.fixture(scope='module')
+def run_folder(tmp_path_factory):
+    """A data tree with the certificate and a folder holding a standard
+    and a heating and cooling sample run.
+    Returns the folder and its correction curves.
+    """
+    root = tmp_path_factory.mktemp('data')
+    shutil.copy2(os.path.join(repo_dir, 'data', cert_file), root)
+    folder = os.path.join(str(root), 'synth', '')
+    os.makedirs(folder)
+    write_export(folder + sample_name, run_rows, cooling=True)
+    write_export(folder + 'ExpDat_sapphsynth.csv', run_rows, standard=True,
+                 seed=1)
+    registry = load_registry(folder + '../')
+    manifest, stamps, depends, file_names = check_update(folder, registry)
+    curves = load_calibration(folder, file_names, depends, registry)[0]
+    return folder, curves
+
+
+@pytest.fixture(scope='module')
+def whole_run(run_folder):
+    """The outputs and metrics of processing the sample run whole."""
+    folder, curves = run_folder
+    names, metrics = process_file(folder, sample_name, curves, all_formats,
+                                  polynomial_models)
+    csv_name, col_name = names[1], names[2]
+    # The columns are copied out of the memory map, since the chunked
+    # runs write over the same file.
+    columns = {name: np.array(values) for name, values
+               in read_columns(folder + col_name)[1].items()}
+    return pd.read_csv(folder + csv_name, index_col=0), columns, metrics
+
+
+@pytest.mark.parametrize('chunk', chunk_sizes)
+def test_chunked_matches_whole_run(run_folder, whole_run, chunk):
+    folder, curves = run_folder
+    whole_csv, whole_col, whole_metrics = whole_run
+    names, metrics = process_file(folder, sample_name, curves, all_formats,
+                                  polynomial_models, chunk=chunk)
+    chunked_csv = pd.read_csv(folder + names[1], index_col=0)
+    chunked_col = read_columns(folder + names[2])[1]
+    # Chunked runs have every column but the local alpha.
+    assert list(chunked_csv.columns) == [column for column in whole_csv.columns
+                                         if column != 'Alpha_local']
+    data_columns = list(chunked_csv.columns[:chunked_csv.columns.get_loc(
+        'Fitted')])
+    pd.testing.assert_frame_equal(chunked_csv[data_columns],
+                                  whole_csv[data_columns])
+    for column in chunked_csv.columns:
+        np.testing.assert_allclose(chunked_col[column], whole_col[column],
+                                   rtol=1e-7, atol=1e-15)
+        np.testing.assert_allclose(chunked_csv[column], whole_csv[column],
+                                   rtol=1e-7, atol=1e-15)
+    assert [segment['kind'] for segment in metrics['segments']] == \
+        ['heating', 'cooling']
+    assert metrics['points'] == whole_metrics['points']
+    for key in ('number', 'kind', 'declared', 'start', 'stop', 'temps'):
+        assert [segment[key] for segment in metrics['segments']] == \
+            [segment[key] for segment in whole_metrics['segments']]
+    for model in polynomial_models:
+        fit, whole_fit = metrics['fits'][model], whole_metrics['fits'][model]
+        np.testing.assert_allclose(fit['domain'], whole_fit['domain'])
+        np.testing.assert_allclose(fit['coef'], whole_fit['coef'],
+                                   rtol=1e-7, atol=1e-12)
+        assert metrics[model] == pytest.approx(whole_metrics[model], rel=1e-6)
+
+
+def test_rebase_poly_stats_round_trip():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(20.0, 600.0, 500)
+    y = 7e-6*x + 4e-9*x**2 + rng.normal(0, 1e-6, 500)
+    stats = update_poly_stats(poly_stats((20.0, 600.0), 5), x, y)
+    original = {key: np.copy(stats[key]) for key in ('xtx', 'xty')}
+    # Onto a wider domain, which matches summing there directly.
+    rebase_poly_stats(stats, (0.0, 1100.0))
+    direct = update_poly_stats(poly_stats((0.0, 1100.0), 5), x, y)
+    np.testing.assert_allclose(stats['xtx'], direct['xtx'], rtol=1e-9)
+    np.testing.assert_allclose(stats['xty'], direct['xty'], rtol=1e-9)
+    np.testing.assert_allclose(poly_stats_fit(stats, 4)[0](x),
+                               poly_stats_fit(direct, 4)[0](x), rtol=1e-9)
+    # And back again.
+    rebase_poly_stats(stats, (20.0, 600.0))
+    np.testing.assert_allclose(stats['xtx'], original['xtx'], rtol=1e-9)
+    np.testing.assert_allclose(stats['xty'], original['xty'], rtol=1e-9)
+    assert stats['n'] == 500
+
+
+def test_find_segments_heating_and_cooling():
+    data = run_data(run_rows, cooling=True)
+    declared = declared_segments(segment_metadata())
+    turn = int(np.flatnonzero(np.diff(data[:, 3]))[0]) + 1
+    labelled = find_segments(data[:, 0], data[:, 1],
+                             data[:, 3].astype(np.int64), declared)
+    assert [(segment['number'], segment['kind'], segment['start'],
+             segment['stop']) for segment in labelled] == \
+        [(1, 'heating', 0, turn), (2, 'cooling', turn, run_rows)]
+    assert [segment['declared'] for segment in labelled] == \
+        [text for text, *_ in declared]
+    # Without the instrument's numbers the split comes from the heating
+    # rate, within a rate window of the turn.
+    unlabelled = find_segments(data[:, 0], data[:, 1], None, declared)
+    assert [segment['kind'] for segment in unlabelled] == ['heating', 'cooling']
+    assert abs(unlabelled[0]['stop'] - turn) < 20
+
+
+@pytest.mark.parametrize('block', [1, 7, 250, run_rows])
+def test_find_segments_block_by_block(block):
+    data = run_data(run_rows, cooling=True)
+    declared = declared_segments(segment_metadata())
+    for labels in (data[:, 3].astype(np.int64), None):
+        state = segment_state(declared)
+        for start in range(0, run_rows, block):
+            rows = slice(start, start + block)
+            update_segments(state, data[rows, 0], data[rows, 1],
+                            None if labels is None else labels[rows])
+        update_segments(state, final=True)
+        assert finish_segments(state)[0] == \
+            find_segments(data[:, 0], data[:, 1], labels, declared)
+
+
+def test_resample_run():
+    data = run_data(run_rows, cooling=True)
+    ddf = pd.DataFrame({'Temp./°C': data[:, 0], 'Time/min': data[:, 1],
+                        'dL/Lo': data[:, 2], 'Segment': data[:, 3],
+                        'Corrected': data[:, 2]})
+    step = 5.0
+    binned = resample_run(ddf, step)
+    temps = binned['Temp./°C'].to_numpy()
+    heating = (binned['Segment'] == 1).to_numpy()
+    # Every row lands in one bin of its segment, on the grid.
+    assert binned['Count'].sum() == run_rows
+    assert binned.loc[heating, 'Count'].sum() == (data[:, 3] == 1).sum()
+    np.testing.assert_allclose(temps, np.round(temps/step)*step)
+    # Bins rise through the heating segment and fall through the cooling.
+    assert list(binned['Segment']) == sorted(binned['Segment'])
+    assert (np.diff(temps[heating]) > 0).all()
+    assert (np.diff(temps[~heating]) < 0).all()
+    # Each bin is the mean of its rows, with their spread.
+    keys = [ddf['Segment'], np.round(ddf['Temp./°C']/step)]
+    groups = ddf.groupby(keys, sort=False)['Corrected']
+    expected = groups.mean().to_numpy()
+    spread = groups.std(ddof=0).to_numpy()
+    np.testing.assert_allclose(binned['Corrected'], expected, rtol=1e-12)
+    np.testing.assert_allclose(binned['Spread'], spread, rtol=1e-9,
+                               atol=1e-15)
@@ -1,32 +1,133 @@
 #!/usr/bin/python3
 
-"""Collects processed data files from the th_exp_fit script and copies them from
+"""Collects processed data files from the th_exp_fit script and links them from
 subdirectories of the data directory into the main directory.
+The files are kept in a content-addressed store (see th_exp_store) as
+hardlinks to the processed files, so collecting costs a few hardlinks
+per new or changed file rather than a copy of every file. With --backup, the raw exports and calibration files are
+mirrored into data_backup the same way.
 """
 
-import os
-import shutil
-import json
+import argparse
 import datetime
+import json
+import os
+from th_exp_parse import is_export
+from th_exp_calibration import cert_file, registry_file_name
+from th_exp_store import default_store, load_index, save_index, store_file, \
+    link_object, data_hash, duplicate_files, listing_diff
 
-# Task 1: Identify all processed files with c.txt or x.txt endings.
-# List all subdirectories. Store "leaf" subdirectory names as keys
-# and matching file names in a value list. Skip sapphire standards.
-listing = {}
-for root, dirs, files in os.walk('data'):
-    if dirs != []:
-        continue
-    listing[root]=list(filter(lambda s: (s.endswith('c.csv') | s.endswith('x.csv'))
-        & ('sapph' not in s),files))
-
-# Task 2: Store the current data file listing as a json
-today = datetime.date.today()
-with open('data/'+str(today.toordinal())+'.dat','w') as datfile:
-    json.dump(listing,datfile)
-
-# Task 3: Copy new files up to the main 'data' directory
-for subdir in listing.keys():
-    for filename in listing[subdir]:
-        if os.path.exists('data/'+filename):
+# Calibration files in the data root kept in the backup: the certificate,
+# the old pickled polynomial and the calibration registry. The coefficient
+# store and volume alphas there are derived, so they are left out.
+backup_root_files = (cert_file, 'cert_poly.pkl', registry_file_name)
+
+
+def collect(data_dir='data', store=None):
+    """Links new or updated processed files from the leaf subdirectories
+    of data_dir up into it, reports runs with identical content, and
+    writes what changed today as <ordinal>.dat.
+    Returns the listing.
+    """
+    if store is None:
+        store = default_store(data_dir)
+    # Task 1: Identify all processed files with c.csv / x.csv endings, or the
+    # matching c.col / x.col columnar files.
+    # List all subdirectories. Store "leaf" subdirectory names as keys
+    # and matching file names in a value list. Skip sapphire standards.
+    listing = {}
+    for root, dirs, files in os.walk(data_dir):
+        if dirs != []:
             continue
-        shutil.copy2(subdir+'/'+filename,'data/'+filename)
\ No newline at end of file
+        listing[root]=sorted(filter(lambda s: (s.endswith('c.csv') | s.endswith('x.csv')
+            | s.endswith('c.col') | s.endswith('x.col'))
+            & ('sapph' not in s),files))
+
+    # Task 2: Store new or changed files and link them up to the main
+    # 'data' directory. Only files whose size or mtime has changed since
+    # the last collect are read.
+    index = load_index(store)
+    hashes = {}
+    data_hashes = {}
+    for subdir in listing.keys():
+        hashes[subdir] = {}
+        data_hashes[subdir] = {}
+        for filename in listing[subdir]:
+            path = os.path.join(subdir, filename)
+            sha = store_file(store, index, path, link=True)
+            hashes[subdir][filename] = sha
+            data_hashes[subdir][filename] = data_hash(index, path)
+            link_object(store, sha, os.path.join(data_dir, filename))
+
+    # Task 3: Report runs with the same data, whatever their headers.
+    for paths in duplicate_files(data_hashes):
+        print('Identical runs:', ', '.join(paths))
+
+    # Task 4: Store what changed today, against the listing as it stood
+    # at the end of the last day anything was collected.
+    today = datetime.date.today().toordinal()
+    state = index['listing']
+    if state.get('day') != today:
+        state['base'] = state.get('current', {})
+        state['day'] = today
+    state['current'] = hashes
+    diff = listing_diff(state['base'], hashes)
+    dat_name = os.path.join(data_dir, str(today)+'.dat')
+    if any(diff.values()):
+        with open(dat_name,'w') as datfile:
+            json.dump(diff,datfile)
+    elif os.path.exists(dat_name):
+        os.remove(dat_name)
+    save_index(store, index)
+    return listing
+
+
+def backup(data_dir='data', backup_dir=None, store=None):
+    """Mirrors the raw exports of the leaf subdirectories, and the
+    calibration files of the data root, into backup_dir as links to the
+    stored copies.
+    Returns the number of backup files added or updated.
+    """
+    if store is None:
+        store = default_store(data_dir)
+    if backup_dir is None:
+        backup_dir = os.path.join(os.path.dirname(os.path.abspath(data_dir)),
+                                  'data_backup')
+    index = load_index(store)
+    updated = 0
+    for root, dirs, files in os.walk(data_dir):
+        if dirs != []:
+            names = [s for s in files if s in backup_root_files]
+        else:
+            names = [s for s in files if (s.endswith('.csv')
+                     | s.endswith('.xlsx')) and is_export(os.path.join(root, s))]
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            sha = store_file(store, index, path)
+            target = os.path.join(backup_dir, os.path.relpath(path, data_dir))
+            updated += link_object(store, sha, target)
+    save_index(store, index)
+    return updated
+
+
+def main(argv=None):
+    """Command line interface; argv defaults to sys.argv[1:]."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir', nargs='?', default='data',
+                        help='root of the data tree (default %(default)s)')
+    parser.add_argument('--store', default=None,
+                        help='content store (default: data_store next to the data root)')
+    parser.add_argument('--backup', nargs='?', const='', default=None,
+                        help='also mirror the raw exports into this folder '
+                        '(default: data_backup next to the data root)')
+    args = parser.parse_args(argv)
+    collect(args.data_dir, args.store)
+    if args.backup is not None:
+        print('Backed up', backup(args.data_dir, args.backup or None,
+                                  args.store), 'new or changed files.')
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,301 @@
 #!/usr/bin/python3
 
-"""
\ No newline at end of file
+"""Multi-model curve fitting for corrected dilatometer data.
+* Polynomial models of several degrees share one QR factorization.
+* Smoothing spline models need scipy; without it they are skipped.
+Each model gives fitted values, alpha (the derivative) and its mean
+squared error, and write_metrics writes them up as fit_metrics.txt.
+A polynomial can also be fitted from running sums (poly_stats), which
+take new points in O(new points) while a run is still being recorded or
+is read in blocks, and can be moved onto a wider domain as it grows.
+local_alpha gives a windowed local slope instead of a global model, which
+keeps steps and droops in alpha that a single polynomial smears out.
+bootstrap_alpha gives confidence bands for a polynomial model's alpha.
+Model names:
+    pN   least squares polynomial of degree N
+    sp   smoothing spline with scipy's default smoothing factor
+    tsp  tight smoothing spline
+"""
+
+# Models fitted to every run, in metrics table order.
+fit_models = ('p4', 'p5', 'sp', 'tsp')
+# Smoothing factors for the spline models; None is scipy's default.
+spline_smoothing = {'sp': None, 'tsp': 1e-8}
+# Full width in kelvin of the local alpha window.
+local_window = 20.0
+# Resamples refitted together by bootstrap_alpha, which bounds the memory
+# of the stacked solves to about points x batch values.
+bootstrap_batch = 100
+# Two-sided confidence level of the bootstrap alpha bands
+bootstrap_level = 0.95
+
+
+def poly_fits(x, y, degrees):
+    """Least squares polynomial fits of several degrees at once.
+    The Vandermonde matrix of the highest degree is factorized once;
+    the fit of each lower degree uses the leading columns of Q and R.
+    Returns a dictionary of Polynomials by degree, with the same domain
+    and window as Polynomial.fit would give them.
+    """
+    import numpy as np
+    from numpy.polynomial import Polynomial, polynomial, polyutils
+    domain = polyutils.getdomain(x)
+    window = np.array([-1., 1.])
+    off, scl = polyutils.mapparms(domain, window)
+    vander = polynomial.polyvander(off + scl*x, max(degrees))
+    q, r = np.linalg.qr(vander)
+    qty = q.T @ y
+    fits = {}
+    for degree in degrees:
+        k = degree + 1
+        coef = np.linalg.solve(r[:k, :k], qty[:k])
+        fits[degree] = Polynomial(coef, domain, window)
+    return fits
+
+
+def poly_stats(domain, degree):
+    """Empty sufficient statistics for a least squares polynomial fit
+    over a fixed domain: the normal equations, the sum of squared values
+    and the point count.
+    """
+    import numpy as np
+    return {'domain': np.array(domain, dtype=np.float64), 'degree': degree,
+            'xtx': np.zeros((degree + 1, degree + 1)),
+            'xty': np.zeros(degree + 1), 'yty': 0.0, 'n': 0}
+
+
+def update_poly_stats(stats, x, y):
+    """Adds points to the sufficient statistics in place. The cost only
+    depends on the number of new points.
+    """
+    import numpy as np
+    from numpy.polynomial import polynomial, polyutils
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    off, scl = polyutils.mapparms(stats['domain'], [-1., 1.])
+    vander = polynomial.polyvander(off + scl*x, stats['degree'])
+    stats['xtx'] += vander.T @ vander
+    stats['xty'] += vander.T @ y
+    stats['yty'] += y @ y
+    stats['n'] += len(x)
+    return stats
+
+
+def rebase_poly_stats(stats, domain):
+    """Moves the sufficient statistics onto a new domain in place, such
+    as a wider one once points fall outside the old. Each power of the
+    new mapped variable is a polynomial in the old one, so this is an
+    exact change of basis of the normal equations.
+    """
+    import numpy as np
+    from numpy.polynomial import polynomial, polyutils
+    domain = np.array(domain, dtype=np.float64)
+    off, scl = polyutils.mapparms(stats['domain'], [-1., 1.])
+    new_off, new_scl = polyutils.mapparms(domain, [-1., 1.])
+    # The new mapped variable is shift + ratio times the old one.
+    ratio = new_scl / scl
+    shift = new_off - ratio*off
+    k = stats['degree'] + 1
+    basis = np.zeros((k, k))
+    for power in range(k):
+        basis[:power + 1, power] = polynomial.polypow([shift, ratio], power)
+    stats['xtx'] = basis.T @ stats['xtx'] @ basis
+    stats['xty'] = basis.T @ stats['xty']
+    stats['domain'] = domain
+    return stats
+
+
+def add_poly_stats(stats, other):
+    """Adds the sufficient statistics of other points in place, moving
+    a copy of them onto this domain first if theirs differs.
+    """
+    import numpy as np
+    if not np.array_equal(other['domain'], stats['domain']):
+        other = rebase_poly_stats(dict(other), stats['domain'])
+    k = stats['degree'] + 1
+    stats['xtx'] += other['xtx'][:k, :k]
+    stats['xty'] += other['xty'][:k]
+    stats['yty'] += other['yty']
+    stats['n'] += other['n']
+    return stats
+
+
+def poly_stats_fit(stats, degree=None):
+    """Solves the normal equations of the sufficient statistics, for
+    their own degree or any lower one, whose normal equations are the
+    leading block.
+    The domain is mapped to [-1, 1] as in Polynomial.fit, which keeps
+    the normal equations well enough conditioned at degree 4 or 5.
+    Returns the Polynomial and its mean squared error.
+    """
+    import numpy as np
+    from numpy.polynomial import Polynomial
+    k = stats['degree'] + 1 if degree is None else degree + 1
+    # lstsq copes with the rank deficient first few updates of a run.
+    coef = np.linalg.lstsq(stats['xtx'][:k, :k], stats['xty'][:k],
+                           rcond=None)[0]
+    fit = Polynomial(coef, stats['domain'], [-1., 1.])
+    if stats['n'] == 0:
+        return fit, np.nan
+    # At the least squares solution the residual sum of squares is
+    # y.y - c.X'y.
+    sse = max(stats['yty'] - coef @ stats['xty'][:k], 0.0)
+    return fit, sse / stats['n']
+
+
+def spline_fit(x, y, smoothing):
+    """Smoothing spline fit. The spline needs strictly increasing x, so
+    points at repeated temperatures are averaged, which also sorts them.
+    """
+    import numpy as np
+    from scipy.interpolate import UnivariateSpline
+    xu, inverse, counts = np.unique(x, return_inverse=True, return_counts=True)
+    yu = np.bincount(inverse, weights=y) / counts
+    return UnivariateSpline(xu, yu, s=smoothing)
+
+
+def local_alpha(x, y, window=local_window):
+    """Local linear regression slope of y against x in a window of the
+    given full width around each point, like a Savitzky-Golay derivative
+    filter but on uneven temperature steps. The window sums come from
+    cumulative sums in one vectorized pass, so the cost does not depend
+    on the window width. Points with fewer than three points in their
+    window get NaN.
+    """
+    import numpy as np
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    order = np.argsort(x, kind='stable')
+    # Centring keeps the cumulative sums small, so differences of
+    # them lose little precision.
+    xs = x[order] - x.mean()
+    ys = y[order] - y.mean()
+    lo = np.searchsorted(xs, xs - window/2, side='left')
+    hi = np.searchsorted(xs, xs + window/2, side='right')
+
+    def window_sums(values):
+        sums = np.concatenate(([0.0], np.cumsum(values)))
+        return sums[hi] - sums[lo]
+
+    n = hi - lo
+    sx = window_sums(xs)
+    sy = window_sums(ys)
+    denom = n*window_sums(xs*xs) - sx*sx
+    numer = n*window_sums(xs*ys) - sx*sy
+    slope = np.full_like(xs, np.nan)
+    good = (n >= 3) & (denom > 0)
+    slope[good] = numer[good] / denom[good]
+    alpha = np.empty_like(slope)
+    alpha[order] = slope
+    return alpha
+
+
+def bootstrap_alpha(x, y, degree, resamples, method='residuals',
+                    level=bootstrap_level, seed=0):
+    """Bootstrap confidence band for the alpha of a least squares
+    polynomial fit at each x.
+    'residuals' adds resampled residuals to the fitted values; 'points'
+    resamples the (x, y) pairs, as multinomial weights on the points.
+    Each batch of resamples is refitted at once: residual resamples are
+    stacked right hand sides for one QR factorization, and point
+    resamples a stack of weighted normal equations.
+    The seed is fixed, so reprocessing a run gives the same bands.
+    Returns the lower and upper band arrays, and the covariance matrix
+    of the resampled coefficients (in the mapped variable, as for
+    Polynomial.fit), from which bands at other temperatures follow.
+    """
+    import numpy as np
+    from numpy.polynomial import polynomial, polyutils
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    k = degree + 1
+    domain = polyutils.getdomain(x)
+    off, scl = polyutils.mapparms(domain, [-1., 1.])
+    vander = polynomial.polyvander(off + scl*x, degree)
+    q, r = np.linalg.qr(vander)
+    coef = np.linalg.solve(r, q.T @ y)
+    residuals = y - vander @ coef
+    if method == 'points':
+        outer = (vander[:, :, None] * vander[:, None, :]).reshape(n, k*k)
+        vander_y = vander * y[:, None]
+    elif method != 'residuals':
+        raise ValueError('Unknown bootstrap method ' + repr(method))
+    rng = np.random.default_rng(seed)
+    coefs = np.empty((k, resamples))
+    for start in range(0, resamples, bootstrap_batch):
+        count = min(bootstrap_batch, resamples - start)
+        picks = rng.integers(0, n, size=(n, count))
+        if method == 'residuals':
+            coefs[:, start:start + count] = coef[:, None] + \
+                np.linalg.solve(r, q.T @ residuals[picks])
+        else:
+            # How many times each point is drawn, by resample.
+            weights = np.bincount((picks + n*np.arange(count)).ravel(),
+                                  minlength=n*count)
+            weights = weights.reshape(count, n).T.astype(np.float64)
+            xtwx = (outer.T @ weights).T.reshape(count, k, k)
+            xtwy = (vander_y.T @ weights).T
+            coefs[:, start:start + count] = \
+                np.linalg.solve(xtwx, xtwy[:, :, None])[:, :, 0].T
+    # Alpha is the derivative in x, so the mapped variable's scale
+    # carries through.
+    deriv_vander = polynomial.polyvander(off + scl*x, degree - 1)
+    deriv_coefs = polynomial.polyder(coefs, scl=scl, axis=0)
+    lower = np.empty(n)
+    upper = np.empty(n)
+    percents = [50*(1 - level), 50*(1 + level)]
+    rows = max(1, n*bootstrap_batch // resamples)
+    for start in range(0, n, rows):
+        alphas = deriv_vander[start:start + rows] @ deriv_coefs
+        lower[start:start + rows], upper[start:start + rows] = \
+            np.percentile(alphas, percents, axis=1)
+    return lower, upper, np.cov(coefs)
+
+
+def fit_all(x, y, models=fit_models):
+    """Fits every model in one pass over a run.
+    Returns a dictionary by model name of (fitted, alpha, mse, fit), where
+    fit is the Polynomial or spline. Spline models that cannot be fitted
+    get NaN values and no fit.
+    """
+    import numpy as np
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    degrees = [int(model[1:]) for model in models if model.startswith('p')]
+    polys = poly_fits(x, y, degrees) if degrees else {}
+    results = {}
+    for model in models:
+        if model.startswith('p'):
+            fit = polys[int(model[1:])]
+            derivative = fit.deriv()
+        else:
+            try:
+                fit = spline_fit(x, y, spline_smoothing[model])
+                derivative = fit.derivative()
+            except (ImportError, ValueError) as error:
+                print('Skipping', model, 'fit:', error)
+                nans = np.full_like(x, np.nan)
+                results[model] = (nans, nans, np.nan, None)
+                continue
+        fitted = fit(x)
+        results[model] = (fitted, derivative(x), np.mean((y - fitted)**2),
+                          fit)
+    return results
+
+
+def write_metrics(path, metrics, models=fit_models):
+    """Writes the mean squared errors of every run's fits to a text file.
+    Takes a dictionary by processed file name of dictionaries of
+    mean squared error by model, plus a 'points' count.
+    """
+    with open(path, 'w') as metric_file:
+        for name in sorted(metrics):
+            run = metrics[name]
+            mses = ', '.join(f'{run.get(model, float("nan")):.4E}'
+                             for model in models)
+            metric_file.write(f"""{name}{run['points']} data points
+Mean Squared Errors ({', '.join(models)}):
+            {mses}
+""")
+    return None
@@ -1,80 +1,165 @@
 # To add a new cell, type '# %%'
 # To add a new markdown cell, type '# %% [markdown]'
 # %%
+"""Plots the alpha curves of every collected run, one figure per sample.
+* The collected file names in data/ are parsed once into an index of
+  sample, orientation and run,
+* each run is loaded once, reading only its temperature and alpha,
+* the sample figures are rendered in parallel by headless workers,
+* and a figure is only rendered again when its runs have changed since
+  the last render, going by the stamps kept in the plot folder.
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+# The figures are only saved, so no display is needed.
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import pandas as pd
-import os
-import re
+from th_exp_columnar import read_columns, col_ext
+from th_exp_coefficients import split_run_name
+
+data_dir = 'data'
+plot_dir = 'testplots'
+plot_ext = '.tif'
+# Render stamps of each figure's runs, kept in the plot folder
+stamp_file_name = 'plot_stamps.json'
+# Line colour of each orientation; any others are black.
+orient_colors = {'100': 'r', '010': 'g', '001': 'b'}
 # %%
-_, __, files = next(os.walk('data'))
-cols=['Sample','Orientation','Run','Filetype']
-namedf = pd.DataFrame(columns=cols)
-files = list(filter(lambda s: s.endswith('csv'),files))
-findletters = re.compile('[a-zA-Z]+')
-finddigits = re.compile('\d+')
+def run_index(data_dir=data_dir):
+    """Lists the collected runs as a dictionary of
+    sample: orientation: run: file name.
+    Runs may be collected as csv, columnar, or both; each is listed once.
+    Where a run has both 'c' and 'x' files, the 'c' file is used because
+    we trust csvs more than workbooks.
+    """
+    _, __, files = next(os.walk(data_dir))
+    csv_files = [s for s in files if s.endswith('csv')]
+    files = csv_files + [s for s in files if s.endswith(col_ext)
+                         and s[:-len(col_ext)]+'.csv' not in csv_files]
+    index = {}
+    for filename in sorted(files):
+        pieces = filename.split('.')
+        # collect 'c' or 'x' character from end of last piece before extension
+        filetype = pieces[-2][-1]
+        names = split_run_name(filename)
+        if names is None:
+            print('Skipping', filename+': not named sample, orientation, run')
+            continue
+        sample, orient, run = names
+        runs = index.setdefault(sample, {}).setdefault(orient, {})
+        if run not in runs or filetype < runs[run][0]:
+            runs[run] = (filetype, filename)
+    # Orientations in descending order, runs in ascending order.
+    return {sample: {orient: {run: index[sample][orient][run][1]
+                              for run in sorted(index[sample][orient])}
+                     for orient in sorted(index[sample], reverse=True)}
+            for sample in sorted(index)}
+
+def load_run(filename, data_dir=data_dir):
+    """Loads only the temperature and alpha columns of a processed run,
+    memory-mapping its columnar file if there is one."""
+    col_name = filename.rsplit('.',1)[0]+col_ext
+    if os.path.exists(os.path.join(data_dir, col_name)):
+        header, arrays = read_columns(os.path.join(data_dir, col_name),
+                                      [0,'Alpha'])
+        temp, alpha = arrays.values()
+        return temp, alpha
+    df = pd.read_csv(os.path.join(data_dir, filename),
+        usecols=lambda c: c.startswith('Temp') | (c == 'Alpha'))
+    return df.iloc[:,0], df['Alpha']
+
+def run_stamps(orients, data_dir=data_dir):
+    """Size and mtime of every file a sample figure is drawn from."""
+    stamps = {}
+    for runs in orients.values():
+        for filename in runs.values():
+            for name in (filename, filename.rsplit('.',1)[0]+col_ext):
+                path = os.path.join(data_dir, name)
+                if os.path.exists(path):
+                    stat = os.stat(path)
+                    stamps[name] = [stat.st_size, stat.st_mtime_ns]
+    return stamps
 # %%
-for filename in files:
-    pieces = filename.split('.')
-    dline = {}
-    # collect 'c' or 'x' character from end of last piece before extension
-    dline['Filetype'] = pieces[-2][-1]
-    stems = pieces[0].split('-')
-    dline['Sample'] = findletters.findall(stems[0])[0]
-    dline['Orientation'] = finddigits.findall(stems[0])[0]
-    prelength = len(dline['Sample'])+len(dline['Orientation'])
-    dline['Run'] = stems[0][prelength:]
-    newline = pd.DataFrame(dline,columns=cols,index=[0])
-    namedf = namedf.append(newline,ignore_index=True)
+def plot_sample(sample, orients, data_dir=data_dir, plot_dir=plot_dir):
+    """Draws the alpha curves of every run of a sample in one figure,
+    the standard orientations first, and saves it.
+    Returns the figure's file name.
+    """
+    fig, ax = plt.subplots()
+    known = [o for o in orient_colors if o in orients]
+    others = [o for o in orients if o not in orient_colors]
+    for orient in known + others:
+        for run, filename in orients[orient].items():
+            temp, alpha = load_run(filename, data_dir)
+            ax.plot(temp, alpha, lw=2, c=orient_colors.get(orient, 'black'),
+                    label=orient+' '+run)
+    ax.set_title(sample)
+    ax.set_xlabel('Temp (Celsius)')
+    ax.set_ylabel('Linear Thermal Exp.')
+    ax.legend()
+    plot_name = sample + plot_ext
+    fig.savefig(os.path.join(plot_dir, plot_name))
+    plt.close(fig)
+    return plot_name
+
+def plot_all(data_dir=data_dir, plot_dir=plot_dir, workers=None,
+             force=False):
+    """Renders the figure of every sample whose runs have changed since
+    the last render, in a pool of worker processes.
+    Returns the list of figures rendered.
+    """
+    os.makedirs(plot_dir, exist_ok=True)
+    stamp_path = os.path.join(plot_dir, stamp_file_name)
+    try:
+        with open(stamp_path, 'r') as stamp_file:
+            old_stamps = json.load(stamp_file)
+    except FileNotFoundError:
+        old_stamps = {}
+    index = run_index(data_dir)
+    stamps = {}
+    todo = []
+    for sample, orients in index.items():
+        stamps[sample] = run_stamps(orients, data_dir)
+        if force or old_stamps.get(sample) != stamps[sample] or \
+                not os.path.exists(os.path.join(plot_dir, sample+plot_ext)):
+            todo.append(sample)
+    rendered = []
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(plot_sample, sample, index[sample],
+                                   data_dir, plot_dir) for sample in todo]
+            for sample, future in zip(todo, futures):
+                try:
+                    rendered.append(future.result())
+                except Exception as error:
+                    print('Failed to plot', sample+':', repr(error))
+                    # Leave it stale so it is tried again next time.
+                    stamps.pop(sample)
+    with open(stamp_path, 'w') as stamp_file:
+        json.dump(stamps, stamp_file, indent=1, sort_keys=True)
+    return rendered
 # %%
-namedf.sort_values(cols,ascending=[True,False,True,True],inplace=True)
-def namegrab(text1,text2,text3,df,filelist):
-    """Finds the filename in a list that matches text1 and text2
-    in columns 1-3 of the dataframe and has the lower value
-    for column 4 because we trust csvs more than workbooks."""
-    text4 = df[(df.iloc[:,0]==text1)&(df.iloc[:,1]==text2)&(df.iloc[:,2]==text3)].iloc[:,3].min()
-    for name in filelist:
-        if (text1 in name)&(str(text2) in name)&(str(text3) in name)&(text4 in name):
-            return name
+def main(argv=None):
+    """Command line interface; argv defaults to sys.argv[1:]."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir', nargs='?', default=data_dir,
+                        help='folder of collected runs (default %(default)s)')
+    parser.add_argument('--out', default=plot_dir,
+                        help='folder for the figures (default %(default)s)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: one per core)')
+    parser.add_argument('--force', action='store_true',
+                        help='render every figure, changed or not')
+    args = parser.parse_args(argv)
+    rendered = plot_all(args.data_dir, args.out, args.workers, args.force)
+    print('Rendered', len(rendered), 'figures:', ', '.join(rendered))
     return None
 # %%
-plotdict = {}
-samples = namedf['Sample'].unique()
-for sample in samples:
-    plotdict[sample]={}
-    or_list = list(namedf[namedf['Sample']==sample].Orientation.unique())
-    for orient in or_list:
-        plotdict[sample][orient]={}
-        run_list = list(namedf[(namedf['Sample']==sample)&
-            (namedf['Orientation']==orient)].Run.unique())
-        for run in run_list:
-            plotdict[sample][orient][run]=namegrab(sample,orient,run,namedf,files)
-# %%
-for sample in plotdict:
-    orients = list(plotdict[sample].keys())
-    if '100' in orients:
-        orients.remove('100')
-        for run in plotdict[sample]['100'].keys():
-            df100 = pd.read_csv('data/'+plotdict[sample]['100'][run])
-            plt.plot(df100.iloc[:,1],df100['Alpha'],lw=2,c='r',label='100 '+run)
-    if '010' in orients:
-        orients.remove('010')
-        for run in plotdict[sample]['010'].keys():
-            df010 = pd.read_csv('data/'+plotdict[sample]['010'][run])
-            plt.plot(df100.iloc[:,1],df100['Alpha'],lw=2,c='g',label='010 '+run)
-    if '001' in orients:
-        orients.remove('001')
-        for run in plotdict[sample]['001'].keys():
-            df001 = pd.read_csv('data/'+plotdict[sample]['001'][run])
-            plt.plot(df001.iloc[:,1],df001['Alpha'],lw=2,c='b',label='001 '+run)
-    if len(orients) > 0:
-        for orient in orients:
-            for run in plotdict[sample][orient].keys():
-                df000 = pd.read_csv('data/'+plotdict[sample][orient][run])
-                plt.plot(df000.iloc[:,1],df000['Alpha'],lw=2,c='black',label=orient+' '+run)
-    plt.title(sample)
-    plt.xlabel('Temp (Celsius)')
-    plt.ylabel('Linear Thermal Exp.')
-    plt.legend()
-    plt.savefig('testplots/'+sample+'.tif')
-    plt.show()
-    plt.clf()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
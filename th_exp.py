@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+"""Single command line entry point for the dilatometer pipeline.
+    th_exp.py <command> [arguments]
+Commands:
+    fit       process new or changed runs (th_exp_fit)
+    archive   archive raw exports as JSON or columnar files
+              (th_exp_data_extractor)
+    watch     process folders as new exports arrive (th_exp_watch)
+    live      follow a run that is still being recorded (th_exp_live)
+    collect   gather processed runs into the data root (collect_data)
+    plot      render the figures of the collected runs (plot_all)
+    query     alpha or dL/Lo of many runs from their stored fits
+              (th_exp_coefficients)
+    volume    volume alpha of each sample's orientation set (th_exp_volume)
+    standard  show or set the sapphire standard of a folder
+              (th_exp_calibration)
+'th_exp.py <command> --help' gives the arguments of each command.
+Only the module of the command that runs is imported. The parsing,
+fitting, calibration and bookkeeping modules import numpy, pandas, scipy,
+openpyxl and the process pool inside the functions that use them, so
+their settings and JSON files can be read without loading any of it, and
+a check of folders that are up to date starts in tens of milliseconds.
+From Python, run(command, argv) runs a command in the calling process,
+so notebooks and batch callers can reuse one warm interpreter.
+"""
+
+import argparse
+import importlib
+
+# Module of each command; each has a main(argv) function.
+commands = {'fit': 'th_exp_fit',
+            'archive': 'th_exp_data_extractor',
+            'watch': 'th_exp_watch',
+            'live': 'th_exp_live',
+            'collect': 'collect_data',
+            'plot': 'plot_all',
+            'query': 'th_exp_coefficients',
+            'volume': 'th_exp_volume',
+            'standard': 'th_exp_calibration'}
+
+
+def run(command, argv=()):
+    """Imports the command's module and runs its main with the list of
+    command line arguments.
+    """
+    if command not in commands:
+        raise ValueError('Unknown command ' + repr(command))
+    return importlib.import_module(commands[command]).main(list(argv))
+
+
+def main(argv=None):
+    """Command line interface; argv defaults to sys.argv[1:]."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=list(commands),
+                        help='pipeline command to run')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='arguments of the command')
+    args = parser.parse_args(argv)
+    return run(args.command, args.args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+
+"""Calibration registry for the certificate and standard corrections.
+The registry is a JSON file kept in the data root (the parent of the
+sample folders):
+    certificates: sha256 of source file: {file, poly}
+    standards: sha256 of source file: {file, poly, segment}
+    folders: sample folder name: {certificate, standard, sha256}
+Polynomials are stored by hash of the file they were fitted to, as
+coefficients, domain and window, so they are safe to load and are shared
+by any folder using the same source file. Each folder entry names its
+certificate and standard files; a folder without one is set up the first
+time it is seen, with the 'sapph' file name convention for the standard.
+A new or changed 'sapph' export in a known folder becomes its standard,
+and 'th_exp.py standard' points a folder at a standard by hand.
+Standards are fitted to their first heating segment only (see
+th_exp_segments); those registered before that are fitted again.
+The correction curves of each certificate and standard pair are cached on
+a shared temperature grid, so correcting a run is an interpolation.
+"""
+
+import argparse
+import json
+import os
+from th_exp_manifest import file_hash, save_json
+
+registry_file_name = 'calibration.json'
+# Certificate data: temperature and dL/Lo in percent, in the data root.
+cert_file = 'sapphire-certificate.xlsx'
+# Degree of the calibration polynomial fits
+deg = 4
+# Sapphire standard exports have this in their file names.
+standard_marker = 'sapph'
+# Segment of the standard runs that is fitted
+standard_segment = 'heating'
+# Shared temperature grid for the correction curves, in degrees C.
+# The certificate covers -200 to 1700 C.
+grid_limits = (-200.0, 1700.0)
+grid_step = 0.25
+# Correction curves by (certificate sha256, standard sha256).
+curve_cache = {}
+
+
+def load_registry(root):
+    """Loads the registry from the data root, or an empty one."""
+    try:
+        with open(root + registry_file_name, 'r') as registry_file:
+            return json.load(registry_file)
+    except FileNotFoundError:
+        return {'certificates': {}, 'standards': {}, 'folders': {}}
+
+
+def save_registry(root, registry):
+    """Writes the registry through a temporary file."""
+    return save_json(root + registry_file_name, registry)
+
+
+def poly_to_dict(poly):
+    """Serializable form of a Polynomial."""
+    return {'coef': poly.coef.tolist(), 'domain': poly.domain.tolist(),
+            'window': poly.window.tolist()}
+
+
+def poly_from_dict(poly_dict):
+    """Rebuilds a Polynomial from poly_to_dict output."""
+    from numpy.polynomial import Polynomial
+    return Polynomial(poly_dict['coef'], poly_dict['domain'],
+                      poly_dict['window'])
+
+
+def fit_certificate(path):
+    """Fits the calibration polynomial to the certificate workbook,
+    which lists temperature and dL/Lo in percent below a 'T' header row.
+    """
+    import openpyxl as xlsx
+    from numpy.polynomial import Polynomial
+    cert_wb = xlsx.load_workbook(path, read_only=True)
+    temps = []
+    lengths = []
+    for row in cert_wb.active.iter_rows(values_only=True):
+        if row[0] is None or row[0] == 'T':
+            continue
+        temps.append(float(row[0]))
+        lengths.append(float(row[1])/100.0)
+    cert_wb.close()
+    return Polynomial.fit(temps, lengths, deg)
+
+
+def folder_entry(registry, folder):
+    """Returns the registry entry for a sample folder, making it if needed."""
+    key = os.path.basename(os.path.normpath(folder))
+    return registry['folders'].setdefault(key, {'certificate': cert_file})
+
+
+def is_standard_name(name):
+    """Checks a data file name against the sapphire standard convention."""
+    return standard_marker in name
+
+
+def folder_standard(registry, folder, stamps, known=None):
+    """Picks a folder's standard from its data file stamps.
+    A 'sapph' file that is new or changed since the folder was last
+    checked (its hash is not the one in known, a dictionary of content
+    hash by file name) replaces the registered standard, the latest one
+    if several arrived. Otherwise the registered file name wins; if that
+    file is gone, a file with the registered content hash is used; a
+    folder seen for the first time falls back to the 'sapph' file name
+    convention.
+    Returns the standard file name, or None if there is none.
+    """
+    entry = folder_entry(registry, folder)
+    standard = entry.get('standard')
+    if standard is not None and known is not None:
+        arrived = [name for name in stamps if is_standard_name(name)
+                   and stamps[name]['sha256'] != known.get(name)
+                   and stamps[name]['sha256'] != entry.get('sha256')]
+        if arrived:
+            standard = max(arrived,
+                           key=lambda name: (stamps[name]['mtime'], name))
+            entry['standard'] = standard
+            entry['sha256'] = stamps[standard]['sha256']
+            return standard
+    if standard in stamps:
+        return standard
+    if standard is not None:
+        for name in sorted(stamps):
+            if stamps[name]['sha256'] == entry.get('sha256'):
+                entry['standard'] = name
+                return name
+    standard = None
+    for name in sorted(stamps):
+        if is_standard_name(name):
+            standard = name
+    if standard is not None:
+        entry['standard'] = standard
+        entry['sha256'] = stamps[standard]['sha256']
+    return standard
+
+
+def certificate_poly(registry, root, name, sha):
+    """Returns the certificate polynomial for a content hash, fitting
+    the certificate file the first time the hash is seen.
+    """
+    if sha not in registry['certificates']:
+        registry['certificates'][sha] = {
+            'file': name, 'poly': poly_to_dict(fit_certificate(root + name))}
+    return poly_from_dict(registry['certificates'][sha]['poly'])
+
+
+def registered_standard(registry, sha):
+    """Returns the registered standard polynomial for a content hash,
+    or None if it has not been fitted yet.
+    """
+    entry = registry['standards'].get(sha)
+    if entry is None or entry.get('segment') != standard_segment:
+        return None
+    return poly_from_dict(entry['poly'])
+
+
+def register_standard(registry, folder, name, sha, poly):
+    """Stores a newly fitted standard polynomial by content hash."""
+    registry['standards'][sha] = {'file': name, 'poly': poly_to_dict(poly),
+                                  'segment': standard_segment}
+    entry = folder_entry(registry, folder)
+    entry['standard'] = name
+    entry['sha256'] = sha
+    return None
+
+
+def assign_standard(registry, folder, name):
+    """Points a folder at the given standard file by hand, for a standard
+    that does not follow the 'sapph' convention or to go back to an
+    older one. Its samples are reprocessed the next time the folder is.
+    """
+    entry = folder_entry(registry, folder)
+    entry['standard'] = name
+    entry['sha256'] = file_hash(folder + name)
+    return entry
+
+
+def correction_curves(cert_sha, cert4, stan_sha, stan4):
+    """Returns the certificate and standard corrections on the shared
+    temperature grid, evaluating each pair of polynomials only once.
+    """
+    import numpy as np
+    key = (cert_sha, stan_sha)
+    if key not in curve_cache:
+        count = int(round((grid_limits[1] - grid_limits[0])/grid_step)) + 1
+        grid = np.linspace(grid_limits[0], grid_limits[1], count)
+        curve_cache[key] = {'grid': grid, 'cert4': cert4, 'stan4': stan4,
+                            'certificate': cert4(grid),
+                            'standard': stan4(grid)}
+    return curve_cache[key]
+
+
+def apply_correction(temps, curves):
+    """Looks up the certificate and standard corrections at each
+    temperature by linear interpolation on the grid. Temperatures off
+    the grid fall back to evaluating the polynomials.
+    Returns the certificate and standard arrays.
+    """
+    import numpy as np
+    temps = np.asarray(temps, dtype=np.float64)
+    grid = curves['grid']
+    certificate = np.interp(temps, grid, curves['certificate'])
+    standard = np.interp(temps, grid, curves['standard'])
+    outside = (temps < grid[0]) | (temps > grid[-1])
+    if outside.any():
+        certificate[outside] = curves['cert4'](temps[outside])
+        standard[outside] = curves['stan4'](temps[outside])
+    return certificate, standard
+
+
+def main(argv=None):
+    """Command line interface; argv defaults to sys.argv[1:]."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', help='data folder')
+    parser.add_argument('standard', nargs='?', default=None,
+                        help='standard file in the folder to use from now on '
+                        '(default: show the current one)')
+    args = parser.parse_args(argv)
+    folder = args.folder
+    if not folder.endswith('/'):
+        folder = folder + '/'
+    registry = load_registry(folder + '../')
+    if args.standard is not None:
+        if not os.path.isfile(folder + args.standard):
+            parser.error('No file ' + args.standard + ' in ' + folder)
+        assign_standard(registry, folder, args.standard)
+        save_registry(folder + '../', registry)
+    entry = registry['folders'].get(os.path.basename(os.path.normpath(folder)),
+                                    {})
+    print(folder, 'standard:', entry.get('standard'))
+    return None
+
+
+if __name__ == '__main__':
+    main()
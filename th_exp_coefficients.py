@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+
+"""Coefficient store and query engine across all processed runs.
+Each run is fully described by its polynomial fits, so the store keeps
+just those and a few parsed metadata fields, in a JSON file in the data
+root (the parent of the sample folders):
+    runs: folder/processed file name: {folder, file, source, sha256,
+        sample, orientation, run, points, metadata, fits, mse}
+where sha256 is the hash of the source export, sample, orientation and
+run are taken from the file name (e.g. albAmel 001 s1r1), metadata holds
+the SAMPLE, SAMPLE LENGTH, RANGE and DATE/TIME fields, and fits holds
+each polynomial model as coefficients, domain and window (see
+th_exp_calibration.poly_to_dict), with the covariance of the degree 4
+coefficients as cov when the run was bootstrapped.
+th_exp_fit keeps the fits and fields in each folder's manifest and
+refreshes the folder's runs here after processing it, so the store can
+always be rebuilt from the manifests without refitting.
+evaluate gives alpha or dL/Lo of many runs at many temperatures in one
+vectorized call, without reading any processed data file:
+    store = load_store('data/')
+    keys = select_runs(store, sample='albAmel', orientation='001')
+    alphas = evaluate(store, keys, [300, 500, 700])
+"""
+
+import argparse
+import json
+import os
+import re
+from th_exp_manifest import load_manifest, save_json
+
+store_file_name = 'coefficients.json'
+# Metadata fields kept for each run, by their export key (with the colon).
+metadata_fields = {'SAMPLE:': 'sample', 'SAMPLE LENGTH /mm:': 'length_mm',
+                   'RANGE:': 'range', 'DATE/TIME:': 'date'}
+# Model evaluated by default; it fills the Alpha column of processed runs.
+default_model = 'p4'
+quantities = ('alpha', 'dL/Lo')
+
+
+def split_run_name(file_name):
+    """Splits a processed file name such as 'albAmel001s1r1-9x.csv' into
+    its sample, orientation and run, e.g. ('albAmel', '001', 's1r1').
+    Returns None for names that do not follow the convention.
+    """
+    stem = file_name.split('.')[0].split('-')[0]
+    match = re.match('([a-zA-Z]+)([0-9]+)', stem)
+    if match is None:
+        return None
+    sample, orientation = match.groups()
+    return sample, orientation, stem[len(sample)+len(orientation):]
+
+
+def run_fields(metadata):
+    """Picks the stored fields out of a run's metadata dictionary.
+    The sample length is kept as a number where it can be read as one.
+    """
+    fields = {}
+    for key, field in metadata_fields.items():
+        value = metadata.get(key)
+        if type(value) == str:
+            value = value.strip()
+        if field == 'length_mm' and value is not None:
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        fields[field] = value
+    return fields
+
+
+def load_store(root):
+    """Loads the store from the data root, or an empty one."""
+    try:
+        with open(root + store_file_name, 'r') as store_file:
+            return json.load(store_file)
+    except FileNotFoundError:
+        return {'runs': {}}
+
+
+def save_store(root, store):
+    """Writes the store through a temporary file."""
+    return save_json(root + store_file_name, store)
+
+
+def folder_runs(folder, manifest):
+    """Store records of the processed runs in a folder's manifest,
+    by store key. Runs processed before fits were kept, and runs with no
+    heating or cooling segment long enough to fit, are left out.
+    """
+    folder_name = os.path.basename(os.path.normpath(folder))
+    runs = {}
+    for source, entry in sorted(manifest['inputs'].items()):
+        metrics = entry.get('metrics')
+        if not metrics or not metrics.get('fits'):
+            continue
+        names = split_run_name(metrics['file'])
+        if names is None:
+            continue
+        record = {'folder': folder_name, 'file': metrics['file'],
+                  'source': source, 'sha256': entry['sha256'],
+                  'points': metrics['points'],
+                  'metadata': metrics.get('metadata', {}),
+                  'fits': metrics['fits'],
+                  'mse': {model: metrics[model] for model in metrics['fits']
+                          if model in metrics}}
+        record['sample'], record['orientation'], record['run'] = names
+        runs[folder_name + '/' + metrics['file']] = record
+    return runs
+
+
+def update_store(root, folder, manifest):
+    """Replaces a folder's runs in the store with those of its manifest."""
+    store = load_store(root)
+    folder_name = os.path.basename(os.path.normpath(folder))
+    store['runs'] = {key: record for key, record in store['runs'].items()
+                     if record['folder'] != folder_name}
+    store['runs'].update(folder_runs(folder, manifest))
+    save_store(root, store)
+    return None
+
+
+def rebuild_store(root, folders):
+    """Builds the store afresh from the manifests of the folders."""
+    store = {'runs': {}}
+    for folder in folders:
+        store['runs'].update(folder_runs(folder, load_manifest(folder)))
+    save_store(root, store)
+    return store
+
+
+def select_runs(store, sample=None, orientation=None, run=None, folder=None):
+    """Store keys of the runs matching every field given, in sorted order.
+    Each field may be a single value or a collection of values.
+    """
+    wanted = {'sample': sample, 'orientation': orientation, 'run': run,
+              'folder': folder}
+    for field, value in wanted.items():
+        if type(value) == str:
+            wanted[field] = {value}
+    keys = []
+    for key, record in sorted(store['runs'].items()):
+        if all(value is None or record[field] in value
+               for field, value in wanted.items()):
+            keys.append(key)
+    return keys
+
+
+def stack_fits(store, keys, model=default_model):
+    """Stacks a model's fits of the runs for vectorized evaluation.
+    Returns the coefficients as an array of shape (degree + 1, runs),
+    padded with zeros for lower degrees, and the offset and scale that
+    map each run's domain onto its window.
+    """
+    import numpy as np
+    fits = [store['runs'][key]['fits'][model] for key in keys]
+    size = max([len(fit['coef']) for fit in fits], default=1)
+    coefs = np.zeros((size, len(fits)))
+    domains = np.array([fit['domain'] for fit in fits]).reshape(-1, 2)
+    windows = np.array([fit['window'] for fit in fits]).reshape(-1, 2)
+    for i, fit in enumerate(fits):
+        coefs[:len(fit['coef']), i] = fit['coef']
+    # As numpy.polynomial.polyutils.mapparms, for every run at once.
+    scale = (windows[:, 1] - windows[:, 0]) / (domains[:, 1] - domains[:, 0])
+    offset = windows[:, 0] - scale*domains[:, 0]
+    return coefs, offset, scale, domains
+
+
+def evaluate(store, keys, temps, quantity='alpha', model=default_model,
+             extrapolate=False):
+    """Evaluates alpha (the derivative of the fit) or the fitted dL/Lo of
+    each run at each temperature, all in one pass of Horner's rule over
+    the stacked coefficients. Temperatures outside a run's fitted range
+    give NaN unless extrapolate is set.
+    Returns an array of shape (runs, temperatures).
+    """
+    import numpy as np
+    from numpy.polynomial import polynomial
+    if quantity not in quantities:
+        raise ValueError('Unknown quantity ' + repr(quantity))
+    temps = np.asarray(temps, dtype=np.float64).ravel()
+    coefs, offset, scale, domains = stack_fits(store, keys, model)
+    if quantity == 'alpha':
+        coefs = polynomial.polyder(coefs, axis=0)
+        if len(coefs) == 0:
+            coefs = np.zeros((1, len(keys)))
+    x = offset[:, None] + scale[:, None]*temps[None, :]
+    values = np.zeros_like(x)
+    for coef in coefs[::-1]:
+        values = values*x + coef[:, None]
+    if quantity == 'alpha':
+        # The derivative is taken in the mapped variable.
+        values *= scale[:, None]
+    if not extrapolate:
+        outside = (temps[None, :] < domains[:, :1]) | \
+            (temps[None, :] > domains[:, 1:])
+        values[outside] = np.nan
+    return values
+
+
+def alpha_variance(store, keys, temps, model=default_model):
+    """Variance of each run's alpha at each temperature, from the
+    covariance of its coefficients. Runs without one get NaN.
+    Returns an array of shape (runs, temperatures).
+    """
+    import numpy as np
+    temps = np.asarray(temps, dtype=np.float64).ravel()
+    coefs, offset, scale, domains = stack_fits(store, keys, model)
+    size = len(coefs)
+    covs = np.full((len(keys), size, size), np.nan)
+    for i, key in enumerate(keys):
+        cov = store['runs'][key]['fits'][model].get('cov')
+        if cov is not None:
+            covs[i, :len(cov), :len(cov)] = cov
+    x = offset[:, None] + scale[:, None]*temps[None, :]
+    # Gradient of alpha with respect to the coefficients: j x^(j-1),
+    # times the scale of the mapped variable.
+    powers = np.arange(size)
+    gradient = powers * x[:, :, None]**np.maximum(powers - 1, 0)
+    gradient *= scale[:, None, None]
+    return np.einsum('rtj,rjk,rtk->rt', gradient, covs, gradient)
+
+
+def main(argv=None):
+    """Command line interface; argv defaults to sys.argv[1:]."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', nargs='?', default='data/',
+                        help='root of the data tree (default data/)')
+    parser.add_argument('--temps', type=float, nargs='+', required=True,
+                        help='temperatures in degrees C')
+    parser.add_argument('--quantity', choices=quantities, default='alpha',
+                        help='value to evaluate (default %(default)s)')
+    parser.add_argument('--model', default=default_model,
+                        help='polynomial model (default %(default)s)')
+    parser.add_argument('--sample', nargs='+', default=None)
+    parser.add_argument('--orientation', nargs='+', default=None)
+    parser.add_argument('--run', nargs='+', default=None)
+    parser.add_argument('--extrapolate', action='store_true',
+                        help='evaluate outside the fitted temperature range')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='rebuild the store from the folder manifests')
+    args = parser.parse_args(argv)
+    root = args.root
+    if not root.endswith('/'):
+        root = root + '/'
+    if args.rebuild:
+        from th_exp_fit import leaf_folders
+        store = rebuild_store(root, leaf_folders(root))
+    else:
+        store = load_store(root)
+    keys = select_runs(store, args.sample, args.orientation, args.run)
+    keys = [key for key in keys if args.model in store['runs'][key]['fits']]
+    values = evaluate(store, keys, args.temps, args.quantity, args.model,
+                      args.extrapolate)
+    print(f"{'run':<44}" + ''.join(f'{temp:>12.1f}' for temp in args.temps))
+    for key, row in zip(keys, values):
+        print(f'{key:<44}' + ''.join(f'{value:>12.4E}' for value in row))
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+"""Binary columnar files for processed dilatometer runs.
+The file layout:
+    8 byte magic string
+    8 byte little-endian length of the JSON header
+    JSON header: column names, row count, dtype and run metadata,
+        padded with spaces so the data starts on a 64 byte boundary
+    one contiguous block of little-endian float64 values per column
+A run too long to hold can be written a block of rows at a time, into a
+file sized up front for its row count (start_columns, write_column_rows).
+Reading memory-maps the file, so each column comes back as a read-only
+view onto the file with no parsing or copying, and columns that are not
+asked for are never read from disk.
+"""
+
+import json
+
+# File extension for columnar files
+col_ext = '.col'
+magic = b'THXCOL1\n'
+# Data blocks start on a multiple of this many bytes.
+alignment = 64
+dtype = '<f8'
+
+
+def write_header(col_file, columns, rows, metadata=None):
+    """Writes the magic string and padded JSON header to an open file.
+    Returns the byte offset of the data.
+    """
+    header = {'columns': [str(name) for name in columns],
+              'rows': rows,
+              'dtype': dtype,
+              'metadata': metadata or {}}
+    header_bytes = json.dumps(header).encode('utf-8')
+    start = len(magic) + 8 + len(header_bytes)
+    header_bytes += b' ' * (-start % alignment)
+    col_file.write(magic)
+    col_file.write(len(header_bytes).to_bytes(8, 'little'))
+    col_file.write(header_bytes)
+    return len(magic) + 8 + len(header_bytes)
+
+
+def write_columns(path, df, metadata=None):
+    """Writes every column of a dataframe as float64 to a columnar file,
+    with an optional dictionary of run metadata in the header.
+    """
+    import numpy as np
+    with open(path, 'wb') as col_file:
+        write_header(col_file, df.columns, len(df), metadata)
+        for name in df.columns:
+            np.ascontiguousarray(df[name], dtype=dtype).tofile(col_file)
+    return None
+
+
+def start_columns(path, columns, rows, metadata=None):
+    """Writes the header of a columnar file of the given columns and row
+    count, and sizes the file for the data, to be filled in block by
+    block with write_column_rows.
+    Returns the byte offset of the data.
+    """
+    with open(path, 'wb') as col_file:
+        offset = write_header(col_file, columns, rows, metadata)
+        col_file.truncate(offset + len(columns)*rows*8)
+    return offset
+
+
+def write_column_rows(path, offset, rows, start, df):
+    """Writes a dataframe block into each column of a file made by
+    start_columns, from row start on; rows is the file's row count.
+    """
+    import numpy as np
+    with open(path, 'r+b') as col_file:
+        for i, name in enumerate(df.columns):
+            col_file.seek(offset + (i*rows + start)*8)
+            np.ascontiguousarray(df[name], dtype=dtype).tofile(col_file)
+    return None
+
+
+def read_column_header(path):
+    """Reads the JSON header of a columnar file.
+    Returns the header dictionary and the byte offset of the data.
+    """
+    with open(path, 'rb') as col_file:
+        if col_file.read(len(magic)) != magic:
+            raise ValueError(path + ' is not a columnar data file.')
+        length = int.from_bytes(col_file.read(8), 'little')
+        header = json.loads(col_file.read(length).decode('utf-8'))
+    return header, len(magic) + 8 + length
+
+
+def read_columns(path, columns=None):
+    """Memory-maps a columnar file.
+    Columns can be picked by name or by position; the default is all.
+    Returns the header dictionary and a dictionary of read-only
+    arrays by column name.
+    """
+    import numpy as np
+    header, offset = read_column_header(path)
+    names = header['columns']
+    rows = header['rows']
+    if columns is None:
+        columns = names
+    if rows == 0:
+        data = np.zeros((len(names), 0), dtype=header['dtype'])
+    else:
+        data = np.memmap(path, dtype=header['dtype'], mode='r',
+                         offset=offset, shape=(len(names), rows))
+    arrays = {}
+    for column in columns:
+        if type(column) == int:
+            column = names[column]
+        arrays[column] = data[names.index(column)]
+    return header, arrays
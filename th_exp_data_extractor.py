@@ -8,31 +8,34 @@ The archive structure:
     JSON files
     metadata stored as key: value pairs
     data stored as key: listing
-The json file base name is the same as the processed data file.
+or, with --format col, binary columnar files (see th_exp_columnar)
+    metadata stored in the header
+    data stored as float64 columns
+The archive file base name is the same as the processed data file.
+archive_folder does the same from Python, and main takes the command line
+arguments as a list, so it can be called without a new interpreter.
 """
 
+import argparse
 import json
-import csv
-import sys
 import os
-import codecs
-import openpyxl as xlsx
-from copy import copy
-from collections import defaultdict
+from th_exp_parse import read_export, is_export
+from th_exp_columnar import write_columns, col_ext
 
 # This is a simple text file with one file name per line.
 record_file_name = 'th_exp_data.dat'
 
 
-def select_data_files(file_names):
-    """Picks out only .csv and .xlsx files for parsing."""
+def select_data_files(folder, file_names):
+    """Picks out only .csv and .xlsx exports for parsing, skipping the
+    processed .csv files th_exp_fit writes into the same folder.
+    """
 
     new_file_names = []
     for name in file_names:
-        if name.endswith('.csv'):
-            new_file_names.append(name)
-        elif name.endswith('.xlsx'):
-            new_file_names.append(name)
+        if name.endswith('.csv') or name.endswith('.xlsx'):
+            if is_export(folder + name):
+                new_file_names.append(name)
         else:
             pass
     return new_file_names
@@ -46,98 +49,55 @@ def check_update(folder):
     if record_file_name not in file_names:
         with open(folder + record_file_name, 'w') as record_file:
             record_file.writelines(record_file_name + '\n')
-        new_file_names = select_data_files(file_names)
+        new_file_names = select_data_files(folder, file_names)
     else:
         new_file_names = []
         with open(folder + record_file_name, 'r') as record_file:
-            old_file_names = record_file.readlines()
+            old_file_names = record_file.read().splitlines()
         for name in file_names:
             if name not in old_file_names:
                 new_file_names.append(name)
-        new_file_names = select_data_files(new_file_names)
+        new_file_names = select_data_files(folder, new_file_names)
 
     return new_file_names
 
 
-def archive_data_file(folder, file_name):
+def archive_data_file(folder, file_name, archive_format='json'):
     """Reads in a data file, processes it into two dictionaries,
-    then dumps it to a JSON file. Returns the new json file name.
+    then dumps it to a JSON file, or to a columnar file if archive_format
+    is 'col'. Returns the new archive file name.
     """
 
-    # Routine to check file type and read data.
-    # In the Netszch data files, the header line for the actual
-    # data starts with a double #, while the metadata lines
-    # start with #, and the data lines start with a space.
-    # Metadata has a ton of whitespace to strip().
-
-    # Kate tells me that the Netszch csv data files are encoded in
-    # ISO-8859-15. The Python documentation is damnably coy on how
-    # to set the encoding for the csv reader or file opener, but I
-    # eventually tracked it down. The routine leaves the degree symbol
-    # as \u00b0 and the letter mu (micro) as \u00b5.
-    # There is also a blank line right before the ## line with
-    # a NUL byte, which is fixed via the generator replace().
-    
-    # The xlsx files cannot be coped with via "csv.reader(... dialect
-    # = 'excel')" and require openpyxl [as xlsx]. This routine leaves
-    # both of the disputed characters as \ufffd.
-
-    if file_name.endswith('.csv'):
-        with open(folder + file_name, 'r', encoding='iso_8859_15') \
-            as raw_file:
-            raw_csv = csv.reader((line.replace('\0','') for line in raw_file),
-                                 skipinitialspace=True, delimiter=',')
-            raw_data = list(raw_csv)        
-    elif file_name.endswith('.xlsx'):
-        raw_wb = xlsx.load_workbook(folder + file_name)
-        raw_data = []
-        for i, row in enumerate(raw_wb.active.values):
-            # The weird filter code knocks out the None values that show up
-            # in the converted cells that had no value in them.
-            # This fixes multiple problems in the data processing loop
-            # below. In particular, it means the len = 0 line skips
-            # the blank line for both file types, and keeps the main data
-            # ingestion code from accidentally trying to eat and parse
-            # None values as column headers or data.
-            raw_data.append(list(filter(None.__ne__,list(row))))
-    else:
+    # Reading is done by th_exp_parse, which streams .xlsx workbooks
+    # row by row and loads the .csv data block in bulk.
+    try:
+        export = read_export(folder + file_name)
+    except ValueError as error:
+        # A file that is not a readable export is reported and skipped,
+        # so the rest of the folder is still archived.
+        print('Cannot process', file_name+':', error)
+        return None
+    if export is None:
         print('Cannot process', file_name)
         return None
+    metadata, df = export
+    file_name_split = file_name.split('.')
+
+    if archive_format == 'col':
+        col_file_name = file_name_split[0] + col_ext
+        write_columns(folder + col_file_name, df.rename(columns=str.strip),
+                      dict(metadata))
+        return col_file_name
 
     data_dict = {}
-    metadata = True
-    for row in raw_data:
-        # To cope with the blank line.
-        # A .csv file generates an empty list there.
-        # An .xlsx file generates a line of None values,
-        # but those are knocked out by the filter above.
-        if len(row) == 0:
-            pass
-        elif type(row[0]) == str and row[0].startswith('##'):
-            metadata = False
-            # Slice off the '##' signal characters. 
-            row[0] = row[0][2:]
-            data_headers = row
-            # Initialize the data dictionary to receive values.
-            for item in row:
-                data_dict[item.strip()] = []
-        elif metadata:
-            # Slice off the '#' signal character.
-            row[0] = row[0][1:]
-            if len(row) > 1 and type(row[1]) == str:
-                data_dict[row[0].strip()] = row[1].strip()
-            elif len(row) > 1:
-                data_dict[row[0].strip()] = row[1]
-            else:
-                data_dict[row[0].strip()] = None
-        else:
-            for i, item in enumerate(data_headers):
-                data_dict[item.strip()].append(float(row[i]))
+    for key, value in metadata:
+        data_dict[key] = value
+    for item in df.columns:
+        data_dict[item.strip()] = df[item].tolist()
 
     # Now we create the new encoded file.
     # At the moment, if there are .csv and .xlsx files with the same base name,
     # one will clobber the other. Could fix this later.
-    file_name_split = file_name.split('.')
     json_file_name = file_name_split[0] + '.json'
     with open(folder + json_file_name, 'w') as json_file:
         json.dump(data_dict, json_file)
@@ -156,20 +116,47 @@ def record_update(folder, new_file_names):
     return None
 
 
-try:
-    folder_to_check = sys.argv[1]
-except:
-    folder_to_check = input("""Enter a directory / folder name to scan for
-                            new files, then press <Enter>: """)
-# Make sure that the folder name has a trailing slash; the processing
-# routines implicitly expect this.
-if not folder_to_check.endswith('/'):
-    folder_to_check = folder_to_check + '/'
-files_to_archive = check_update(folder_to_check)
-if not files_to_archive:
-    print('Folder is up to date.')
-else:
-    new_file_names = copy(files_to_archive)
+def archive_folder(folder, archive_format='json'):
+    """Archives the folder's new data files and updates its record.
+    Returns the names of the files archived and created, empty if the
+    folder is up to date or nothing could be read.
+    """
+    files_to_archive = check_update(folder)
+    if not files_to_archive:
+        return []
+    new_file_names = []
     for filename in files_to_archive:
-        new_file_names.append(archive_data_file(folder_to_check, filename))
-    record_update(folder_to_check, new_file_names)
+        archive_file_name = archive_data_file(folder, filename,
+                                              archive_format)
+        # Files that could not be read are left off the record, so they
+        # are tried again next time.
+        if archive_file_name is not None:
+            new_file_names += [filename, archive_file_name]
+    if new_file_names:
+        record_update(folder, new_file_names)
+    return new_file_names
+
+
+def main(argv=None):
+    """Command line interface; argv defaults to sys.argv[1:]."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', nargs='?', help='data folder to archive')
+    parser.add_argument('--format', choices=['json', 'col'], default='json',
+                        help='archive format (default: json)')
+    args = parser.parse_args(argv)
+    folder_to_check = args.folder
+    if folder_to_check is None:
+        folder_to_check = input("""Enter a directory / folder name to scan for
+                            new files, then press <Enter>: """)
+    # Make sure that the folder name has a trailing slash; the processing
+    # routines implicitly expect this.
+    if not folder_to_check.endswith('/'):
+        folder_to_check = folder_to_check + '/'
+    if not archive_folder(folder_to_check, args.format):
+        print('Folder is up to date.')
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -1,257 +1,937 @@
 #!/usr/bin/python3
 
 """Netszch dilatometer themal expansion data extraction and fitting routine.
-* It takes a folder / directory name from command line or asks user
-* then checks folder's archive record against directory contents
-* then processes new data and archives it.
+* It takes a folder / directory name from command line or asks user,
+  or with --tree walks every leaf folder of the data tree,
+* then checks each folder's manifest against directory contents
+* then processes new or changed data in parallel and archives it.
+fit_folders does the same from Python, and main takes the command line
+arguments as a list, so notebooks and batch callers can reuse one warm
+process.
+With --chunk, runs are read and written in blocks of rows, so the memory
+of a long run is bounded by the block size.
 """
 
-import csv
-import sys
+import argparse
 import os
-import codecs
-import openpyxl as xlsx
-from copy import copy
-from collections import defaultdict
-import pickle
-import pandas as pd
-import numpy as np
-from numpy.polynomial import Polynomial
+from th_exp_parse import read_export, read_export_blocks, is_export
+from th_exp_columnar import start_columns, write_column_rows, col_ext
+from data_fitting import fit_all, write_metrics, fit_models, local_alpha, \
+    local_window, bootstrap_alpha, poly_stats, update_poly_stats, \
+    rebase_poly_stats, add_poly_stats, poly_stats_fit
+from th_exp_manifest import load_manifest, save_manifest, file_stamp, \
+    file_hash, is_stale, output_names, record_entry
+from th_exp_telemetry import stage, enable, read_records, summary
+from th_exp_calibration import load_registry, save_registry, folder_entry, \
+    folder_standard, certificate_poly, registered_standard, \
+    register_standard, correction_curves, apply_correction, poly_to_dict, \
+    is_standard_name
+from th_exp_coefficients import run_fields, update_store
+from th_exp_volume import update_volumes
+from th_exp_segments import find_segments, declared_segments, \
+    primary_segment, segment_numbers, segment_rows, segment_state, \
+    update_segments, finish_segments, isothermal_rate, rate_window, \
+    min_segment_rows
 
 # Degree of polynomial fits
 deg = 4
-# Simple text file listing of processed directory contents
-# with one file name per line.
-record_file_name = 'th_exp_data.dat'
-# File name for certificate polynomial
-cert_file = 'cert_poly.pkl'
-# File extension for standard polynomial
-stan_file = '_stan_poly.pkl'
-
-def check_update(folder):
-    """Checks the folder for new files not listed in its local record.
-    Returns a list of new filenames.
-    """
-    file_names = os.listdir(folder)
-    if record_file_name not in file_names:
-        with open(folder + record_file_name, 'w') as record_file:
-            record_file.write(record_file_name + '\n')
-        new_file_names = select_data_files(file_names)
-    else:
-        new_file_names = []
-        with open(folder + record_file_name, 'r') as record_file:
-            old_file_names = record_file.readlines()
-        for name in file_names:
-            if name not in old_file_names:
-                new_file_names.append(name)
-        new_file_names = select_data_files(new_file_names)
-    return new_file_names
+# Output formats for processed runs by default: 'csv' text. 'col' binary
+# columnar files (see th_exp_columnar) are written when asked for.
+output_formats = ('csv',)
+# Fit metrics table of the whole tree, kept beside the data root.
+metrics_file_name = 'fit_metrics.txt'
 
-def select_data_files(file_names):
-    """Picks out only .csv and .xlsx files for parsing."""
+def check_update(folder, registry, settings=None):
+    """Checks the folder's data files against its manifest.
+    Looks up the folder's certificate and standard in the registry.
+    Returns the manifest, the current stamps of the data files,
+    the current calibration and analysis settings dependencies, and a
+    list of the file names that are new, changed, or made with old
+    calibrations or other settings.
+    """
+    manifest = load_manifest(folder)
+    file_names = select_data_files(folder, sorted(os.listdir(folder)),
+                                   output_names(manifest))
+    stamps = {}
+    for name in file_names:
+        stamps[name] = file_stamp(folder + name, manifest['inputs'].get(name))
+    known = {name: entry['sha256']
+             for name, entry in manifest['inputs'].items()}
+    standard = folder_standard(registry, folder, stamps, known)
+    cert_name = folder_entry(registry, folder)['certificate']
+    depends = {'certificate': {'file': cert_name,
+                               'sha256': file_hash(folder + '../' + cert_name)}}
+    if standard is not None:
+        depends['standard'] = {'file': standard,
+                               'sha256': stamps[standard]['sha256']}
+    if settings is not None:
+        depends.update(settings)
     new_file_names = []
     for name in file_names:
-        if name.endswith('.csv'):
+        if is_standard_name(name) and name != standard:
+            # Another standard, replaced or not yet in use, is never a
+            # sample; it is recorded so it does not count as new again.
+            record_entry(manifest, name, stamps[name], [], {})
+            continue
+        # The standard fit itself does not use the certificate.
+        if name == standard:
+            name_depends = {}
+        else:
+            name_depends = depends
+        entry = manifest['inputs'].get(name)
+        if is_stale(folder, entry, stamps[name], name_depends):
             new_file_names.append(name)
-        elif name.endswith('.xlsx'):
+        elif name != standard and 'fits' not in entry.get('metrics', {}):
+            # Processed before fit metrics and coefficients were kept.
             new_file_names.append(name)
+        else:
+            # Touched but unchanged: keep the new mtime so the file
+            # is not hashed again next time.
+            entry.update(stamps[name])
+    return manifest, stamps, depends, new_file_names
+
+def select_data_files(folder, file_names, known_outputs=()):
+    """Picks out only .csv and .xlsx files for parsing, skipping
+    our own outputs.
+    """
+    new_file_names = []
+    for name in file_names:
+        if name in known_outputs:
+            pass
+        elif name.endswith('.csv') or name.endswith('.xlsx'):
+            # Processed csv files sit in the same folder as the exports.
+            if is_export(folder + name):
+                new_file_names.append(name)
         else:
             pass
     return new_file_names
 
-def standard_poly(folder,file_names):
-    """Checks the list of new file names for a new sapphire standard.
-    If none, passes back the existing pickled polynomial.
-    If there is one, passes the file to the parser, gets dataframe,
-    fits the polynomial, pickles it, and passes it back.
+def output_base_name(file_name):
+    """Base name for a data file's outputs.
+    To avoid clobbering, if the original file was a csv, suffix 'c' to
+    the base file name, 'x' for xlsx.
     """
-    new_standard = ''
-    for name in file_names:
-        if 'sapph' in name:
-            new_standard = name
-    if new_standard == '':
-        with open(stan_file,'rb') as cellar:
-            stan4 = pickle.load(cellar)
+    file_name_split = file_name.split('.')
+    if file_name_split[-1] == 'xlsx':
+        return file_name_split[0] + 'x'
     else:
-        st_file_name, stdf = parse_file(folder,new_standard)
+        return file_name_split[0] + 'c'
+
+def standard_poly(folder, standard, sha, refit, registry):
+    """If the standard is unchanged, passes back its registered polynomial.
+    If it is new or changed, passes the file to the parser, gets dataframe,
+    fits the polynomial, registers it by content hash, and passes it back.
+    Returns the polynomial and a list of the files created.
+    """
+    from numpy.polynomial import Polynomial
+    stan4 = registered_standard(registry, sha)
+    if stan4 is not None and not refit:
+        return stan4, []
+    with stage('standard', folder, standard) as record:
+        st_file_name, stdf, metadata, segments = parse_file(folder,standard)
+        # Only the heating segment, not any cooling after it.
+        heating = primary_segment(segments)
+        stdf = stdf.iloc[heating['start']:heating['stop']]
         stan4 = Polynomial.fit(stdf.iloc[:,0],stdf['dL/Lo'],deg)
-        st_name_split = st_file_name.split('.')
-        with open(folder+st_name_split[0]+stan_file,'wb') as cellar:
-            pickle.dump(stan4,cellar)
-    return stan4
+        record['rows'] = len(stdf)
+    register_standard(registry, folder, standard, sha, stan4)
+    return stan4, [st_file_name]
 
-def process_directory(folder, file_names):
-    """Loads certificate polynomial from parent folder.
+def load_calibration(folder, file_names, depends, registry):
+    """Gets the certificate polynomial from the registry.
     Calls standard_poly to create or load standard polynomial.
-    Calls process_file on each data file to process and archive.
+    Returns the correction curves of the pair and a dictionary of the
+    files created from the folder's standard.
     """
-    with open(folder+'../'+cert_file,'rb') as cellar:
-        cert4 = pickle.load(cellar)
-    stan4 = standard_poly(folder,file_names)
-    new_file_names = []
-    for name in file_names:
-        if 'sapph' not in name:
-            new_file_names.extend(process_file(folder, name, cert4, stan4))
-    return new_file_names
+    cert = depends['certificate']
+    stan = depends['standard']
+    cert4 = certificate_poly(registry, folder+'../', cert['file'],
+                             cert['sha256'])
+    stan4, stan_outputs = standard_poly(folder, stan['file'], stan['sha256'],
+                                        stan['file'] in file_names, registry)
+    curves = correction_curves(cert['sha256'], cert4, stan['sha256'], stan4)
+    new_file_names = {}
+    if stan['file'] in file_names:
+        new_file_names[stan['file']] = stan_outputs
+    return curves, new_file_names
+
+def leaf_folders(root):
+    """Lists the leaf subdirectories of the data tree in sorted order,
+    each with the trailing slash the processing routines expect.
+    """
+    folders = []
+    for path, dirs, files in os.walk(root):
+        if dirs == []:
+            folders.append(os.path.join(path, ''))
+    return sorted(folders)
+
+def process_folders(folders, workers=None, formats=output_formats, pool=None,
+                    window=local_window, bootstrap=0, method='residuals',
+                    grid=None, chunk=None):
+    """Checks each folder against its manifest and resolves its standard,
+    then fans the sample files of all the folders out across a process
+    pool (a new one, or the one given) and calls process_file on each.
+    A folder or file that fails is reported and left out of the results,
+    so it is picked up again next time.
+    Returns a dictionary by folder of what record_update needs: the
+    manifest, stamps and dependencies from check_update, and the files
+    created from and fit metrics of each data file.
+    With a chunk size, each file is processed in blocks of that many rows
+    (see process_file_chunked), which rules out a bootstrap or grid.
+    """
+    if chunk and (bootstrap or grid):
+        raise ValueError('Chunked processing cannot bootstrap or resample '
+                         'onto a grid.')
+    # Settings that change the outputs are recorded with the calibrations.
+    settings = {'local_window': window,
+                'segments': {'isothermal_rate': isothermal_rate,
+                             'rate_window': rate_window,
+                             'min_rows': min_segment_rows}}
+    if bootstrap:
+        settings['bootstrap'] = {'resamples': bootstrap, 'method': method}
+    if grid:
+        settings['grid_step'] = grid
+    if chunk:
+        # The block size does not change the outputs, but chunked runs
+        # have no spline or local alpha columns.
+        settings['chunked'] = True
+    pending = {}
+    jobs = []
+    registries = {}
+    for folder in folders:
+        root = os.path.normpath(folder + '../')
+        if root not in registries:
+            registries[root] = load_registry(folder + '../')
+        registry = registries[root]
+        manifest, stamps, depends, file_names = check_update(folder, registry,
+                                                             settings)
+        if not file_names:
+            save_manifest(folder, manifest)
+            print(folder, 'is up to date.')
+            continue
+        if 'standard' not in depends:
+            print('No sapphire standard in', folder)
+            continue
+        try:
+            curves, new_file_names = load_calibration(folder, file_names,
+                                                      depends, registry)
+        except Exception as error:
+            print('Failed to load calibration for', folder+':', repr(error))
+            continue
+        pending[folder] = {'manifest': manifest, 'stamps': stamps,
+                           'depends': depends,
+                           'new_file_names': new_file_names, 'metrics': {}}
+        for name in file_names:
+            if name != depends['standard']['file'] \
+                    and not is_standard_name(name):
+                jobs.append((folder, name, curves, formats, fit_models,
+                             window, bootstrap, method, grid, chunk))
+    for root, registry in registries.items():
+        save_registry(os.path.join(root, ''), registry)
+    results = run_jobs(jobs, workers, pool)
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            print('Failed to process', job[0]+job[1]+':', repr(result))
+            continue
+        outputs, metrics = result
+        pending[job[0]]['new_file_names'][job[1]] = outputs
+        pending[job[0]]['metrics'][job[1]] = metrics
+    return pending
+
+def run_jobs(jobs, workers=None, pool=None):
+    """Calls process_file on each job: serially if workers is 1, else in
+    the given pool or a new one. Each process_file call is independent
+    once the calibrations are loaded, and results come back in job order
+    whatever order the workers finish in, so the output does not depend
+    on scheduling.
+    Returns a list of (outputs, metrics), or the exception raised, by job.
+    """
+    results = []
+    if pool is None and (workers == 1 or len(jobs) < 2):
+        for job in jobs:
+            try:
+                results.append(process_file(*job))
+            except Exception as error:
+                results.append(error)
+        return results
+    if pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as new_pool:
+            return run_jobs(jobs, workers, new_pool)
+    futures = [pool.submit(process_file, *job) for job in jobs]
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as error:
+            results.append(error)
+    return results
 
 def parse_file(folder, file_name):
     """Reads in a data file, processes it into a string and a dataframe,
-    then dumps the string to a text file and returns the dataframe.
+    then dumps the string to a text file and returns the dataframe
+    together with the metadata as a dictionary.
+    Splits the run into heating, cooling and isothermal segments, numbered
+    in a Segment column, and returns the list of segments too.
     """
-    # Routine to check file type and read data.
-    # In the Netszch data files, the header line for the actual
-    # data starts with a double #, while the metadata lines
-    # start with #, and the data lines start with a space.
-    # Metadata has a ton of whitespace to strip().
-    #
-    # Kate tells me that the Netszch csv data files are encoded in
-    # ISO-8859-15. The Python documentation is damnably coy on how
-    # to set the encoding for the csv reader or file opener, but I
-    # eventually tracked it down. The routine leaves the degree symbol
-    # as \u00b0 and the letter mu (micro) as \u00b5.
-    # There is also a blank line right before the ## line with
-    # a NUL byte, which is fixed via the generator replace().
-    #
-    # The xlsx files cannot be coped with via "csv.reader(... dialect
-    # = 'excel')" and require openpyxl [as xlsx]. This routine leaves
-    # both of the disputed characters as \ufffd.
+    # Reading is done by th_exp_parse, which finds the '##' header line
+    # and metadata block in one pass and loads the data block in bulk.
     print(file_name)
-    if file_name.endswith('.csv'):
-        with open(folder + file_name,'r',encoding='iso_8859_15',errors='ignore') \
-            as raw_file:
-            raw_csv = csv.reader((line.replace('\0','') for line in raw_file),
-                                 skipinitialspace=True, delimiter=',')
-            raw_data = list(raw_csv)        
-    elif file_name.endswith('.xlsx'):
-        raw_wb = xlsx.load_workbook(folder + file_name)
-        raw_data = []
-        for row in raw_wb.active.values:
-            # The weird filter code knocks out the None values that show up
-            # in the converted cells that had no value in them.
-            # This fixes multiple problems in the data processing loop
-            # below. In particular, it means the len = 0 line skips
-            # the blank line for both file types, and keeps the main data
-            # ingestion code from accidentally trying to eat and parse
-            # None values as column headers or data.
-            raw_data.append(list(filter(None.__ne__,list(row))))
-    else:
-        print('Cannot process', file_name)
-        return None
+    with stage('parse', folder, file_name) as record:
+        export = read_export(folder + file_name)
+        if export is None:
+            print('Cannot process', file_name)
+            return None
+        metadata, df = export
+        record['rows'] = len(df)
+        label = segment_column(df.columns)
+        segments = find_segments(df.iloc[:,0].to_numpy(),
+                                 df.iloc[:,1].to_numpy(),
+                                 df[label].to_numpy() if label else None,
+                                 declared_segments(dict(metadata)))
+        # Only take the first three columns. Any fourth columns are alphas
+        # calculated by the instrument software and Anne does not regard
+        # them as reliable.
+        df = df.iloc[:, 0:3]
+        print(list(df.columns))
+        df['Segment'] = segment_numbers(segments)
+        text_file_name = write_metadata_text(folder, file_name, metadata)
+    return text_file_name, df, dict(metadata), segments
+
+def segment_column(columns):
+    """Name of the column in which multi-segment exports number each
+    row's program segment, or None.
+    """
+    for column in columns:
+        if column.strip() == 'Segment':
+            return column
+    return None
+
+def write_metadata_text(folder, file_name, metadata):
+    """Dumps the metadata pairs of a data file to its text file.
+    Returns the text file name.
+    """
     metadata_text = []
-    metadata = True
-    for row in raw_data:
-        # To cope with the blank line.
-        # A .csv file generates an empty list there.
-        # An .xlsx file would generate a line of None values,
-        # but those are knocked out by the filter above.
-        if len(row) == 0:
-            pass
-        elif type(row[0]) == str and row[0].startswith('##'):
-            metadata = False
-            print(row)
-            # Slice off the '##' signal characters. 
-            row[0] = row[0][2:]
-            # Initialize the dataframe to receive values.
-            # Only take the first three columns. Any fourth columns are alphas
-            # calculated by the instrument software and Anne does not regard
-            # them as reliable.
-            df = pd.DataFrame(columns=row[0:3])
-        elif metadata:
-            # Slice off the '#' signal character.
-            row[0] = row[0][1:]
-            if len(row) > 1 and type(row[1]) == str:
-                metadata_text.append(row[0].strip()+' '+row[1].strip())
-            elif len(row) > 1:
-                metadata_text.append(row[0].strip()+' '+str(row[1]))
-            else:
-                metadata_text.append(row[0].strip())
+    for key, value in metadata:
+        if type(value) == str:
+            metadata_text.append(key+' '+value)
+        elif value is not None:
+            metadata_text.append(key+' '+str(value))
         else:
-            newdata = np.array([float(row[0]),float(row[1]),float(row[2])])
-            newline = pd.DataFrame(newdata.reshape(1,3),columns=df.columns)
-            df = df.append(newline)
+            metadata_text.append(key)
     # Now we create the new text file.
-    # To avoid clobbering, if the original file was a csv, suffix 'c' to
-    # the base file name, 'x' for xlsx.
-    file_name_split = file_name.split('.')
-    if file_name_split[-1] == 'xlsx':
-        suffix = 'x.txt'
-    else:
-        suffix = 'c.txt'
-    text_file_name = file_name_split[0] + suffix
+    text_file_name = output_base_name(file_name) + '.txt'
     with open(folder+text_file_name,'w',encoding='utf-8',errors='ignore') as text_file:
         text_file.write('\n'.join(metadata_text))
-    return text_file_name, df
+    return text_file_name
 
-def process_file(folder, file_name, cert4, stan4):
+def process_file(folder, file_name, curves, formats=output_formats,
+                 models=fit_models, window=local_window, bootstrap=0,
+                 method='residuals', grid=None, chunk=None):
     """Passes file name to parse_file to archive metadata and retrieve data.
+    Look up certificate and standard corrections on the calibration grid.
     Add column of corrected data with certificate and standard to dataframe.
-    Calculate delta T and averaged / engineering alpha.
-    Fit the corrected data with a polynomial.
+    If a grid step is given, resample the run onto the temperature grid.
+    Calculate delta T and averaged / engineering alpha within each segment.
+    Fit each heating and cooling segment on its own with fit_segment.
+    Dump corrected dataframe to csv and / or columnar file.
+    Pass back the metadata and data file names, and the fit metrics and
+    coefficients. The errors, fits and point count are those of the first
+    heating segment; the span and errors of every segment are listed
+    under 'segments'.
+    With a chunk size, the run is handed to process_file_chunked."""
+    import numpy as np
+    if chunk:
+        return process_file_chunked(folder, file_name, curves, formats,
+                                    models, chunk)
+    with stage('process', folder, file_name) as process_record:
+        text_file_name, ddf, metadata, segments = parse_file(folder, file_name)
+        with stage('correct', folder, file_name) as record:
+            record['rows'] = len(ddf)
+            # Note that the Temp/oC column is passed as iloc[:,0]
+            # because of the special degree character I don't want to deal with.
+            ddf['Certificate'], ddf['Standard'] = apply_correction(ddf.iloc[:,0],
+                                                                   curves)
+            ddf['Corrected'] = ddf['dL/Lo']+ddf['Certificate']-ddf['Standard']
+            if grid:
+                ddf = resample_run(ddf, grid)
+                segments = segment_rows(segments, ddf['Segment'])
+            # Each segment is measured from its first row, or from the start
+            # of the hold before it, so a cooling segment starts at zero too.
+            temps = ddf.iloc[:,0].to_numpy()
+            corrected = ddf['Corrected'].to_numpy()
+            origins = [segment['start'] for segment in segments]
+            for i in range(1, len(segments)):
+                if segments[i-1]['kind'] == 'isothermal':
+                    origins[i] = origins[i-1]
+            origins = np.repeat(origins, [segment['stop'] - segment['start']
+                                          for segment in segments])
+            ddf['delT'] = temps - temps[origins]
+            ddf['EngAlpha'] = (corrected - corrected[origins]) / ddf['delT']
+        process_record['rows'] = len(ddf)
+        with stage('fit', folder, file_name) as record:
+            record['rows'] = len(ddf)
+            # The segments are fitted one after another in this worker;
+            # the pool already has a process per file.
+            primary = primary_segment(segments)
+            metrics = run_metrics(text_file_name, metadata)
+            columns = {column: np.full(len(ddf), np.nan)
+                       for column in fit_columns(models, bootstrap)}
+            for segment in segments:
+                rows = slice(segment['start'], segment['stop'])
+                summary = add_segment(metrics, segment, temps[segment['start']],
+                                      temps[segment['stop']-1])
+                if summary is None:
+                    continue
+                values, mses, fits = fit_segment(temps[rows], corrected[rows],
+                                                 models, window, bootstrap,
+                                                 method)
+                for column, value in values.items():
+                    columns[column][rows] = value
+                add_segment_fits(metrics, summary, segment is primary, mses,
+                                 fits)
+            for column, value in columns.items():
+                ddf[column] = value
+        with stage('write', folder, file_name) as record:
+            record['rows'] = len(ddf)
+            outputs = start_outputs(folder, file_name, text_file_name,
+                                    list(ddf.columns), len(ddf), metadata,
+                                    metrics, formats)
+            write_outputs(outputs, 0, ddf)
+    return [text_file_name] + finish_outputs(outputs), metrics
+
+def run_metrics(text_file_name, metadata):
+    """Empty fit metrics of a run, named for its processed csv file. The
+    polynomial coefficients and a few metadata fields go in the
+    coefficient store (see th_exp_coefficients).
+    """
+    return {'file': text_file_name.split('.')[0]+'.csv', 'points': 0,
+            'metadata': run_fields(metadata), 'fits': {}, 'segments': []}
+
+def add_segment(metrics, segment, first_temp, last_temp):
+    """Lists a segment's rows and temperature span in the run metrics.
+    Returns its summary, to which add_segment_fits adds the fits, or None
+    for a segment that is not fitted: isothermal or too short.
+    """
+    summary = {key: segment[key] for key in
+               ('number', 'kind', 'declared', 'start', 'stop')}
+    summary['temps'] = [float(first_temp), float(last_temp)]
+    metrics['segments'].append(summary)
+    if segment['kind'] == 'isothermal' or \
+            segment['stop'] - segment['start'] < min_segment_rows:
+        return None
+    return summary
+
+def add_segment_fits(metrics, summary, primary, mses, fits):
+    """Records a fitted segment's errors, and for the primary segment
+    its point count, errors and fits as those of the run.
+    """
+    summary['mse'] = mses
+    if primary:
+        metrics['points'] = summary['stop'] - summary['start']
+        metrics.update(mses)
+        metrics['fits'] = fits
+    return None
+
+def start_outputs(folder, file_name, text_file_name, columns, rows, metadata,
+                  metrics, formats=output_formats):
+    """Starts the csv and / or columnar outputs of a processed run with
+    the given columns and row count, to be filled in with write_outputs,
+    a block of rows at a time or the whole run as one block.
+    The columnar file carries the metadata in its header, so a reader
+    does not need the text file alongside it.
+    The outputs are written to temporary files that finish_outputs moves
+    into place, so a collected run hardlinked to an older output (see
+    th_exp_store) keeps the content it was stored with.
+    Returns the output state.
+    """
+    base_name = text_file_name.split('.')[0]
+    outputs = {'folder': folder, 'rows': rows}
+    if 'csv' in formats:
+        outputs['csv'] = base_name+'.csv'
+    if 'col' in formats:
+        outputs['col'] = base_name+col_ext
+        metadata['source'] = file_name
+        metadata['segments'] = metrics['segments']
+        outputs['offset'] = start_columns(folder+outputs['col']+'.tmp',
+                                          columns, rows, metadata)
+    return outputs
+
+def write_outputs(outputs, start, ddf):
+    """Writes a block of rows of a processed run, from row start on, to
+    the outputs made by start_outputs.
+    """
+    folder = outputs['folder']
+    if 'csv' in outputs:
+        if start == 0:
+            ddf.to_csv(folder+outputs['csv']+'.tmp')
+        else:
+            ddf.to_csv(folder+outputs['csv']+'.tmp', mode='a', header=False)
+    if 'col' in outputs:
+        write_column_rows(folder+outputs['col']+'.tmp', outputs['offset'],
+                          outputs['rows'], start, ddf)
+    return None
+
+def finish_outputs(outputs):
+    """Moves the finished outputs into place.
+    Returns their file names, in csv, col order.
+    """
+    names = [outputs[kind] for kind in ('csv', 'col') if kind in outputs]
+    for name in names:
+        os.replace(outputs['folder']+name+'.tmp', outputs['folder']+name)
+    return names
+
+def fit_columns(models, bootstrap=0, local=True):
+    """Names of the fitted and alpha columns of a processed run, in order.
+    The degree deg model fills the Fitted and Alpha columns, the others
+    get their name as a suffix. local adds the Alpha_local column.
+    """
+    columns = []
+    for model in models:
+        if model == 'p'+str(deg):
+            columns += ['Fitted', 'Alpha']
+            if local:
+                columns.append('Alpha_local')
+            if bootstrap:
+                columns += ['Alpha_lo', 'Alpha_hi']
+        else:
+            columns += ['Fitted_'+model, 'Alpha_'+model]
+    return columns
+
+def fit_segment(temps, corrected, models=fit_models, window=local_window,
+                bootstrap=0, method='residuals'):
+    """Fits the corrected data of one segment with each of the models.
     Calculate derivative = alpha at each temperature.
-    Dump corrected dataframe to csv.
-    Pass back the metadata and data file names."""
-    text_file_name, ddf = parse_file(folder, file_name)
-    # Note that the Temp/oC column is passed as iloc[:,0]
-    # because of the special degree character I don't want to deal with.
-    ddf['Certificate'] = cert4(ddf.iloc[:,0])
-    ddf['Standard'] = stan4(ddf.iloc[:,0])
-    ddf['Corrected'] = ddf['dL/Lo']+ddf['Certificate']-ddf['Standard']
-    ddf['delT'] = ddf.iloc[:,0].apply(lambda x: x - ddf.iloc[0,0])
-    ddf['EngAlpha'] = ddf['Corrected'] / ddf['delT']
-    data4 = Polynomial.fit(ddf.iloc[:,0],ddf['Corrected'],deg)
-    ddf['Fitted'] = data4(ddf.iloc[:,0])
-    alpha3 = data4.deriv()
-    ddf['Alpha'] = alpha3(ddf.iloc[:,0])
-    file_name_split = text_file_name.split('.')
-    csv_file_name = file_name_split[0]+'.csv'
-    ddf.to_csv(folder+csv_file_name)
-    # not sure whether it's better to pass back as two entities
-    # or a two entity list
-    return [text_file_name, csv_file_name]
-
-def record_update(folder, new_file_names):
-    """After a successful archival action, updates the local record
-    with the names of files processed and created.
+    Calculate local alpha over a window of the given width in kelvin.
+    If bootstrap is given, resample the degree deg fit that many times
+    for a confidence band of its alpha.
+    Returns the fit_columns values, the mean squared error of each model,
+    and the coefficients of each polynomial model.
+    """
+    # All the models are fitted in one pass; the polynomial degrees
+    # share one factorization.
+    values = {}
+    mses = {}
+    fits = {}
+    for model, (fitted, alpha, mse, fit) in fit_all(temps, corrected,
+                                                    models).items():
+        if model == 'p'+str(deg):
+            values['Fitted'] = fitted
+            values['Alpha'] = alpha
+            # The local slope sits next to the model alpha for comparison.
+            values['Alpha_local'] = local_alpha(temps, corrected, window)
+        else:
+            values['Fitted_'+model] = fitted
+            values['Alpha_'+model] = alpha
+        mses[model] = mse
+        if model.startswith('p'):
+            fits[model] = poly_to_dict(fit)
+        if model == 'p'+str(deg) and bootstrap:
+            values['Alpha_lo'], values['Alpha_hi'], cov = \
+                bootstrap_alpha(temps, corrected, deg, bootstrap, method)
+            # The bootstrap covariance carries the alpha band on to the
+            # volume alpha (see th_exp_volume).
+            fits[model]['cov'] = cov.tolist()
+    return values, mses, fits
+
+def process_file_chunked(folder, file_name, curves, formats=output_formats,
+                         models=fit_models, chunk=100000):
+    """Processes a run in blocks of chunk rows and two passes over the
+    export, so memory depends on the block size, not the run length.
+    The first pass corrects each block, splits it into segments with
+    update_segments, and adds it to running least squares sums by raw
+    piece (add_pieces). The sums of each segment's pieces give its fits.
+    The second pass corrects each block again and writes out the columns
+    of process_file, a block at a time. Only the polynomial models can
+    be fitted from sums, so the spline models and the local alpha are
+    left out, as are bootstrap bands and grids.
+    Pass back the metadata and data file names, and the fit metrics and
+    coefficients, as process_file does."""
+    import numpy as np
+    models = [model for model in models if model.startswith('p')]
+    degree = max(int(model[1:]) for model in models)
+    path = folder + file_name
+    print(file_name)
+    with stage('process', folder, file_name) as process_record:
+        with stage('scan', folder, file_name) as record:
+            state = None
+            pieces = {}
+            pending = (np.zeros(0), np.zeros(0))
+            rows = 0
+            for metadata, block in read_export_blocks(path, chunk):
+                if state is None:
+                    print(list(block.columns[0:3]))
+                    label = segment_column(block.columns)
+                    state = segment_state(declared_segments(dict(metadata)))
+                temps, corrected = correct_block(block, curves)
+                ids = update_segments(state, temps, block.iloc[:,1],
+                                      block[label] if label else None)
+                # Rows are summed once update_segments has settled them.
+                pending = add_pieces(pieces, ids,
+                                     np.concatenate((pending[0], temps)),
+                                     np.concatenate((pending[1], corrected)),
+                                     degree)
+                rows += len(block)
+            add_pieces(pieces, update_segments(state, final=True), *pending,
+                       degree)
+            segments, piece_of = finish_segments(state)
+            record['rows'] = rows
+        process_record['rows'] = rows
+        text_file_name = write_metadata_text(folder, file_name, metadata)
+        metadata = dict(metadata)
+        metrics = run_metrics(text_file_name, metadata)
+        primary = primary_segment(segments)
+        # The first row of each segment, or of the hold before it, is the
+        # origin of its delta T and engineering alpha.
+        origins = np.zeros((len(segments), 2))
+        polys = {}
+        for index, segment in enumerate(segments):
+            members = [pieces[piece] for piece in range(len(piece_of))
+                       if piece_of[piece] == index]
+            origins[index] = members[0]['first']
+            if index > 0 and segments[index-1]['kind'] == 'isothermal':
+                origins[index] = origins[index-1]
+            summary = add_segment(metrics, segment, members[0]['first'][0],
+                                  members[-1]['last'])
+            if summary is None:
+                continue
+            stats = segment_stats(members, degree)
+            mses = {}
+            fits = {}
+            polys[index] = {}
+            for model in models:
+                fit, mses[model] = poly_stats_fit(stats, int(model[1:]))
+                polys[index][model] = (fit, fit.deriv())
+                fits[model] = poly_to_dict(fit)
+            add_segment_fits(metrics, summary, segment is primary, mses, fits)
+        with stage('write', folder, file_name) as record:
+            record['rows'] = rows
+            outputs = None
+            starts = np.array([segment['start'] for segment in segments])
+            numbers = np.array([segment['number'] for segment in segments])
+            start = 0
+            for _, block in read_export_blocks(path, chunk):
+                ddf = block.iloc[:, 0:3].copy()
+                ddf.index = range(start, start + len(ddf))
+                index = np.searchsorted(starts, ddf.index, side='right') - 1
+                ddf['Segment'] = numbers[index]
+                temps = ddf.iloc[:,0].to_numpy()
+                ddf['Certificate'], ddf['Standard'] = apply_correction(temps,
+                                                                       curves)
+                ddf['Corrected'] = ddf['dL/Lo']+ddf['Certificate']-ddf['Standard']
+                ddf['delT'] = temps - origins[index, 0]
+                ddf['EngAlpha'] = (ddf['Corrected'] - origins[index, 1]) / \
+                    ddf['delT']
+                values = {column: np.full(len(ddf), np.nan)
+                          for column in fit_columns(models, local=False)}
+                for i, fit in polys.items():
+                    rows_in = index == i
+                    for model, (poly, deriv) in fit.items():
+                        suffix = '' if model == 'p'+str(deg) else '_'+model
+                        values['Fitted'+suffix][rows_in] = poly(temps[rows_in])
+                        values['Alpha'+suffix][rows_in] = deriv(temps[rows_in])
+                for column, value in values.items():
+                    ddf[column] = value
+                if outputs is None:
+                    outputs = start_outputs(folder, file_name, text_file_name,
+                                            list(ddf.columns), rows, metadata,
+                                            metrics, formats)
+                write_outputs(outputs, start, ddf)
+                start += len(ddf)
+    return [text_file_name] + finish_outputs(outputs), metrics
+
+def correct_block(block, curves):
+    """Corrects the dL/Lo of a block of an export with the certificate
+    and standard.
+    Returns the temperatures and the corrected values.
+    """
+    temps = block.iloc[:,0].to_numpy()
+    certificate, standard = apply_correction(temps, curves)
+    return temps, block['dL/Lo'].to_numpy() + certificate - standard
+
+def piece_domain(low, high):
+    """Fit domain of a range of temperatures, widened to a kelvin for a
+    piece held at one temperature, which has no range to map.
     """
-    with open(folder + record_file_name, 'a') as record_file:
-        record_file.write('\n'.join(new_file_names))
+    if high - low < 1.0:
+        return (low - 0.5, high + 0.5)
+    return (low, high)
+
+def add_pieces(pieces, ids, temps, corrected, degree):
+    """Adds the rows settled by update_segments, the leading rows of the
+    arrays, to the running least squares sums of their raw pieces. Each
+    piece keeps its first row, last temperature and range, and its sums
+    are moved onto a wider domain whenever a row falls outside.
+    Returns the rows not yet settled.
+    """
+    import numpy as np
+    settled = len(ids)
+    bounds = np.flatnonzero(np.diff(ids)) + 1
+    for first, stop in zip(np.concatenate(([0], bounds)).tolist(),
+                           np.concatenate((bounds, [settled])).tolist()):
+        if stop <= first:
+            continue
+        x = temps[first:stop]
+        low, high = float(x.min()), float(x.max())
+        piece = pieces.get(int(ids[first]))
+        if piece is None:
+            piece = {'first': (float(x[0]), float(corrected[first])),
+                     'range': [low, high],
+                     'stats': poly_stats(piece_domain(low, high), degree)}
+            pieces[int(ids[first])] = piece
+        else:
+            piece['range'] = [min(piece['range'][0], low),
+                              max(piece['range'][1], high)]
+            domain = piece['stats']['domain']
+            if piece['range'][0] < domain[0] or piece['range'][1] > domain[1]:
+                rebase_poly_stats(piece['stats'], piece_domain(*piece['range']))
+        piece['last'] = float(x[-1])
+        update_poly_stats(piece['stats'], x, corrected[first:stop])
+    return temps[settled:], corrected[settled:]
+
+def segment_stats(members, degree):
+    """Adds up the least squares sums of a segment's raw pieces, moved
+    onto the segment's temperature range, the domain Polynomial.fit
+    would give it.
+    """
+    stats = poly_stats(piece_domain(
+        min(member['range'][0] for member in members),
+        max(member['range'][1] for member in members)), degree)
+    for member in members:
+        add_poly_stats(stats, member['stats'])
+    return stats
+
+def resample_run(ddf, step):
+    """Bins a corrected run onto the shared temperature grid of multiples
+    of step, each column in one vectorized pass. Each bin keeps the mean
+    of every column, its point count, and the standard deviation of the
+    corrected data as its spread. Empty bins are dropped. The bins are
+    taken within each segment of the Segment column and come out in
+    segment order, rising in temperature for a heating segment and
+    falling for a cooling one.
+    Returns the binned dataframe, with the grid temperatures first.
+    """
+    import numpy as np
+    import pandas as pd
+    temps = ddf.iloc[:,0].to_numpy()
+    numbers = ddf['Segment'].to_numpy().astype(np.int64)
+    grid = np.round(temps/step).astype(np.int64)
+    # Bins of a segment whose temperature falls are sorted by the negated
+    # grid index, so they keep the order they were recorded in.
+    first = np.unique(numbers, return_index=True)[1]
+    stops = np.append(first[1:], len(numbers))
+    falling = temps[stops - 1] < temps[first]
+    direction = np.repeat(np.where(falling, -1, 1), stops - first)
+    keys, inverse, counts = np.unique(np.column_stack((numbers, direction*grid)),
+                                      axis=0, return_inverse=True,
+                                      return_counts=True)
+    inverse = inverse.ravel()
+    binned = {}
+    for column in ddf.columns:
+        binned[column] = np.bincount(inverse, weights=ddf[column].to_numpy(),
+                                     minlength=len(keys)) / counts
+    # Every row of a bin shares its direction, so this mean is exact.
+    binned[ddf.columns[0]] = keys[:,1] * step * \
+        np.bincount(inverse, weights=direction, minlength=len(keys)) / counts
+    binned['Segment'] = keys[:,0]
+    deviations = ddf['Corrected'].to_numpy() - binned['Corrected'][inverse]
+    binned['Count'] = counts
+    binned['Spread'] = np.sqrt(np.bincount(inverse, weights=deviations**2,
+                                           minlength=len(keys)) / counts)
+    return pd.DataFrame(binned)
+
+def record_update(folder, manifest, stamps, new_file_names, depends,
+                  metrics):
+    """After a successful archival action, updates the manifest
+    with the stamps, outputs, dependencies and fit metrics of the files
+    processed, the folder's runs in the coefficient store, and the volume
+    alphas of the samples they belong to. Outputs an earlier run of a
+    file made that this one did not, such as a columnar file no longer
+    asked for, are removed so they are not collected out of date.
+    """
+    with stage('record', folder) as record:
+        record['rows'] = len(new_file_names)
+        for name, outputs in new_file_names.items():
+            old_outputs = manifest['inputs'].get(name, {}).get('outputs', [])
+            for old_name in set(old_outputs) - set(outputs):
+                if os.path.exists(folder + old_name):
+                    os.remove(folder + old_name)
+            if name == depends.get('standard', {}).get('file'):
+                record_entry(manifest, name, stamps[name], outputs, {})
+            else:
+                record_entry(manifest, name, stamps[name], outputs, depends,
+                             metrics.get(name))
+        save_manifest(folder, manifest)
+        update_store(folder + '../', folder, manifest)
+        update_volumes(folder + '../')
     return None
 
-# Take a folder / directory name from command line or ask user
-try:
-    folder_to_check = sys.argv[1]
-except:
-    folder_to_check = input("""Enter a directory / folder name to scan for
+def collect_metrics(folders):
+    """Gathers the fit metrics of every run from the folders' manifests.
+    Returns a dictionary by processed file name.
+    """
+    metrics = {}
+    for folder in folders:
+        for entry in load_manifest(folder)['inputs'].values():
+            if entry.get('metrics'):
+                metrics[entry['metrics']['file']] = entry['metrics']
+    return metrics
+
+def fit_folders(folders, workers=None, formats=output_formats,
+                window=local_window, bootstrap=0, method='residuals',
+                grid=None, metrics=None, profile=None, chunk=None):
+    """Processes the new or changed data of each folder, updates the
+    manifests, and writes the fit metrics table of every run in the
+    folders if a path is given. profile is None, 'time' or 'memory' for
+    the stage telemetry, whose summary is printed. chunk is a block size
+    in rows for runs too long to hold whole (see process_file_chunked).
+    Returns the process_folders results.
+    """
+    # Check each folder's manifest against directory contents,
+    # then process new data and archive it.
+    # Processing steps:
+    # <root function process_folders>
+    # * For each folder:
+    #    * Look up the folder's certificate and standard in the calibration
+    #       registry in the data/ directory (root).
+    #    * If the standard file in this directory is new or changed, fit a
+    #       polynomial to its heating segment. Store it in the registry by
+    #       content hash.
+    #    * If not, load the registered standard polynomial.
+    #    * Evaluate the correction curves on the shared temperature grid.
+    # * For each new or changed data file, or each file made with an older
+    #    certificate or standard, in a pool of worker processes:
+    # <secondary function process_file>
+    #    * Parse the metadata.
+    #    * Control for clobbering: add a suffix to indicate csv or xlsx input.
+    #    * Dump metadata to a text file.
+    #    * Read in the data to a new pandas dataframe.
+    #    * Split the run into heating, cooling and isothermal segments.
+    #    * Interpolate the correction curves at each temperature point.
+    #    * Optionally, bin the run onto a shared temperature grid, keeping
+    #       each bin's point count and spread.
+    #    * Calculate delta-T and average (engineering) alpha at each
+    #       temperature, from the start of its segment.
+    #    * Fit polynomials and splines to the corrected data of each
+    #       heating and cooling segment.
+    #    * Store each model's instantaneous alpha (derivative) at each
+    #       temperature point, and its mean squared error.
+    #    * Store the local alpha, the slope of a straight line fitted over
+    #       a window of temperatures around each point.
+    #    * Optionally, bootstrap the degree 4 fit and store the confidence
+    #       band of its alpha.
+    #    * Dump dataframe to a CSV file and / or a binary columnar file.
+    #    * File base names are the same as the input data file.
+    #    * With a chunk size, read the file a block at a time instead:
+    #       correct, segment and sum each block for the polynomial fits,
+    #       then read it again to write the outputs block by block.
+    if profile:
+        run = enable(memory=(profile == 'memory'))
+    processed = process_folders(folders, workers, formats, window=window,
+                                bootstrap=bootstrap, method=method, grid=grid,
+                                chunk=chunk)
+    # Update the manifests.
+    for folder, update in processed.items():
+        record_update(folder, **update)
+    # Write the fit metrics table for every run in the folders.
+    if metrics is not None:
+        write_metrics(metrics, collect_metrics(folders))
+    # Summarize the stage records of this run from the folders' logs,
+    # if any file was processed.
+    if profile:
+        records = read_records(folders, run)
+        if records:
+            print(summary(records))
+    return processed
+
+def add_processing_args(parser):
+    """Adds the processing options shared by th_exp_fit and th_exp_watch
+    to an argument parser: the workers, the output formats and the
+    settings that go in the manifest depends.
+    """
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: one per core)')
+    parser.add_argument('--format', nargs='+', choices=['csv', 'col'],
+                        default=list(output_formats),
+                        help="output formats for processed runs: 'csv' and / "
+                        "or 'col' binary columnar files (default: csv)")
+    parser.add_argument('--window', type=float, default=local_window,
+                        help='width in kelvin of the local alpha window '
+                        '(default %(default)s)')
+    parser.add_argument('--bootstrap', type=int, default=0,
+                        help='resamples for alpha confidence bands (default: none)')
+    parser.add_argument('--bootstrap-method', choices=['residuals', 'points'],
+                        default='residuals',
+                        help='resample the fit residuals or the data points '
+                        '(default %(default)s)')
+    parser.add_argument('--grid', type=float, default=None,
+                        help='resample each run onto a temperature grid of '
+                        'this step in kelvin before fitting (default: no)')
+    parser.add_argument('--chunk', type=int, default=None,
+                        help='read and write each run in blocks of this many '
+                        'rows, in two passes, to bound memory on long runs; '
+                        'fits the polynomial models only (default: whole runs)')
+    return parser
+
+def processing_settings(parser, args):
+    """Checks the options added by add_processing_args, exiting through
+    the parser on a combination that cannot be processed.
+    Returns the window, bootstrap, method, grid and chunk keyword
+    arguments of process_folders.
+    """
+    if args.chunk and (args.bootstrap or args.grid):
+        parser.error('--chunk cannot be combined with --bootstrap or --grid')
+    return {'window': args.window, 'bootstrap': args.bootstrap,
+            'method': args.bootstrap_method, 'grid': args.grid,
+            'chunk': args.chunk}
+
+def main(argv=None):
+    """Command line interface; argv defaults to sys.argv[1:]."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', nargs='?',
+                        help='data folder, or the root of the data tree with --tree')
+    parser.add_argument('--tree', action='store_true',
+                        help='process every leaf folder under the given root (default data/)')
+    add_processing_args(parser)
+    parser.add_argument('--profile', action='store_true',
+                        help='log the time and rows/sec of each stage of each '
+                        'file, and print a summary')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='as --profile, and also trace the peak memory of '
+                        'each stage, which is slower')
+    parser.add_argument('--metrics', default=None,
+                        help='write the fit metrics table of every run here '
+                        '(default: fit_metrics.txt beside the tree root with '
+                        '--tree)')
+    args = parser.parse_args(argv)
+    settings = processing_settings(parser, args)
+    # Take a folder / directory name from command line or ask user
+    folder_to_check = args.folder
+    if folder_to_check is None and args.tree:
+        folder_to_check = 'data/'
+    elif folder_to_check is None:
+        folder_to_check = input("""Enter a directory / folder name to scan for
                             new files, then press <Enter>: """)
-# Make sure that the folder name has a trailing slash; the processing
-# routines implicitly expect this.
-if not folder_to_check.endswith('/'):
-    folder_to_check = folder_to_check + '/'
-
-# Check folder's archive record against directory contents
-files_to_archive = check_update(folder_to_check)
-if not files_to_archive:
-    print('Folder is up to date.')
-else:
-# Process new data and archive it.
-# Processing steps:
-# <root function process_directory>
-# * Import certificate polynomial from data/ directory (root)
-# * If there is a new standard file in this directory, fit a polynomial to it.
-#    Dump this polynomial to a pickle file.
-# * If there is not a new standard file, load the old standard polynomial.
-# * For each new data file:
-# <secondary function process_file>
-#    * Parse the metadata.
-#    * Control for clobbering: add a suffix to indicate csv or xlsx input.
-#    * Dump metadata to a text file.
-#    * Read in the data to a new pandas dataframe.
-#    * Use certificate and standard to correct data at each temperature point.
-#    * Calculate delta-T and average (engineering) alpha at each temperature.
-#    * Fit polynomial to the corrected data.
-#    * Store instantaneous alpha (derivative) at each temperature point.
-#    * Dump dataframe to a CSV file.
-#    * File base names are the same as the input data file.
-    new_file_names = process_directory(folder_to_check,files_to_archive)
-# Update the record file.
-    record_update(folder_to_check,new_file_names)
\ No newline at end of file
+    # Make sure that the folder name has a trailing slash; the processing
+    # routines implicitly expect this.
+    if not folder_to_check.endswith('/'):
+        folder_to_check = folder_to_check + '/'
+    if args.tree:
+        folders = leaf_folders(folder_to_check)
+    else:
+        folders = [folder_to_check]
+
+    if args.metrics is None and args.tree:
+        args.metrics = os.path.normpath(folder_to_check + '../'
+                                        + metrics_file_name)
+    profile = None
+    if args.profile_memory:
+        profile = 'memory'
+    elif args.profile:
+        profile = 'time'
+    fit_folders(folders, args.workers, args.format, metrics=args.metrics,
+                profile=profile, **settings)
+    return None
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+"""Live alpha for a Netszch dilatometer run that is still being recorded.
+* It follows a .csv export as the instrument software appends to it,
+* corrects only the newly appended rows with the folder's certificate
+  and standard,
+* splits them into segments as th_exp_fit does and adds them to running
+  sums for the degree 4 fit of the primary heating segment, so each
+  update costs O(new rows) rather than a refit of the whole run, and the
+  lead-in hold and the cooling are left out of the fit,
+* and prints the current temperature, alpha and mean squared error, so a
+  bad mount shows up long before the run is over.
+Nothing is written; th_exp_fit processes the finished file as usual.
+Only .csv exports can be followed, since .xlsx files are written whole.
+"""
+
+import argparse
+import csv
+import os
+import time
+import numpy as np
+from th_exp_parse import csv_encoding, read_header
+from th_exp_calibration import load_registry, save_registry, apply_correction
+from th_exp_fit import check_update, load_calibration, deg, segment_column, \
+    add_pieces, segment_stats
+from th_exp_segments import declared_segments, segment_state, \
+    update_segments, settled_segments, primary_segment
+from data_fitting import poly_stats_fit
+
+# Seconds between checks of the file for new rows
+poll_interval = 10.0
+
+
+def folder_curves(folder):
+    """Loads the correction curves of the folder's certificate and
+    standard, fitting the standard first if it is new.
+    """
+    registry = load_registry(folder + '../')
+    manifest, stamps, depends, file_names = check_update(folder, registry)
+    if 'standard' not in depends:
+        raise ValueError('No sapphire standard in ' + folder)
+    curves = load_calibration(folder, file_names, depends, registry)[0]
+    save_registry(folder + '../', registry)
+    return curves
+
+
+def read_lines(raw_file, partial):
+    """Reads whatever has been appended to the file since the last call.
+    A last line without its newline is still being written; it is passed
+    back to be completed on the next call.
+    Returns the complete lines, decoded, and the partial line.
+    """
+    chunk = partial + raw_file.read()
+    lines = chunk.split(b'\n')
+    partial = lines.pop()
+    # The blank line before the '##' line has a NUL byte in it.
+    return [line.decode(csv_encoding, errors='ignore').replace('\0', '')
+            for line in lines], partial
+
+
+def parse_rows(lines, ncols):
+    """Parses complete data lines into a float array of ncols columns.
+    Trailing empty columns and blank lines are dropped.
+    """
+    rows = []
+    for line in lines:
+        values = line.split(',')[:ncols]
+        if len(values) == ncols and values[0].strip():
+            rows.append(values)
+    return np.array(rows, dtype=np.float64).reshape(-1, ncols)
+
+
+def primary_fit(state, pieces):
+    """Fits the primary segment of the rows settled so far, from the
+    sums of its raw pieces, as process_file_chunked fits it.
+    Returns the fit, its mean squared error, its row count and the
+    segment, or None if no rows of it are settled yet.
+    """
+    segments, piece_of = settled_segments(state)
+    primary = primary_segment(segments)
+    if primary is None:
+        return None
+    index = segments.index(primary)
+    members = [pieces[piece] for piece in range(len(piece_of))
+               if piece_of[piece] == index and piece in pieces]
+    if not members:
+        return None
+    stats = segment_stats(members, deg)
+    fit, mse = poly_stats_fit(stats)
+    return fit, mse, stats['n'], primary
+
+
+def follow(folder, file_name, interval=poll_interval, idle=None):
+    """Follows the export, updating the fit as rows are appended.
+    Rows go into the fit of the primary segment once update_segments has
+    settled them, about a rate window behind the instrument.
+    Stops after idle seconds without new rows, if given.
+    Returns the final fit, its mean squared error and the row count.
+    """
+    curves = folder_curves(folder)
+    header_lines = []
+    columns = None
+    state = None
+    pieces = {}
+    pending = (np.zeros(0), np.zeros(0))
+    partial = b''
+    last_change = time.monotonic()
+    with open(folder + file_name, 'rb') as raw_file:
+        while True:
+            lines, partial = read_lines(raw_file, partial)
+            if lines:
+                last_change = time.monotonic()
+            if columns is None:
+                # Gather lines until the '##' column header line is in.
+                header_lines.extend(lines)
+                for i, line in enumerate(header_lines):
+                    if line.startswith('##'):
+                        rows = csv.reader(header_lines[:i + 1],
+                                          skipinitialspace=True)
+                        metadata, columns = read_header(rows)
+                        label = segment_column(columns)
+                        if label is not None:
+                            label = list(columns).index(label)
+                        state = segment_state(
+                            declared_segments(dict(metadata)))
+                        lines = header_lines[i + 1:]
+                        print(file_name, metadata_summary(metadata))
+                        break
+            if columns is not None and lines:
+                data = parse_rows(lines, len(columns))
+                if len(data) > 0:
+                    # Only the new rows are corrected and summed.
+                    certificate, standard = apply_correction(data[:, 0],
+                                                             curves)
+                    corrected = data[:, 2] + certificate - standard
+                    ids = update_segments(
+                        state, data[:, 0], data[:, 1],
+                        None if label is None else data[:, label])
+                    pending = add_pieces(
+                        pieces, ids, np.concatenate((pending[0], data[:, 0])),
+                        np.concatenate((pending[1], corrected)), deg)
+                    result = primary_fit(state, pieces)
+                    if result is not None:
+                        fit, mse, n, primary = result
+                        temp = data[-1, 0]
+                        alpha = fit.deriv()(temp)
+                        print(f'{n:8d} rows {temp:8.2f} C  '
+                              f'alpha {alpha:.4E} /K  mse {mse:.4E}  '
+                              f'segment {primary["number"]} '
+                              f'{primary["kind"]}')
+            if idle is not None and time.monotonic() - last_change > idle:
+                break
+            time.sleep(interval)
+    if state is None:
+        return None, np.nan, 0
+    add_pieces(pieces, update_segments(state, final=True), *pending, deg)
+    result = primary_fit(state, pieces)
+    if result is None:
+        return None, np.nan, 0
+    return result[:3]
+
+
+def metadata_summary(metadata):
+    """Short description of the run from its metadata."""
+    metadata = dict(metadata)
+    return ', '.join(str(metadata[key]) for key in ('SAMPLE:', 'RANGE:')
+                     if metadata.get(key))
+
+
+def main(argv=None):
+    """Command line interface; argv defaults to sys.argv[1:]."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='.csv export being recorded')
+    parser.add_argument('--interval', type=float, default=poll_interval,
+                        help='seconds between checks (default %(default)s)')
+    parser.add_argument('--idle', type=float, default=None,
+                        help='stop after this many seconds without new rows')
+    args = parser.parse_args(argv)
+    folder, file_name = os.path.split(args.path)
+    try:
+        follow(os.path.join(folder, ''), file_name, args.interval, args.idle)
+    except KeyboardInterrupt:
+        pass
+    return None
+
+
+if __name__ == '__main__':
+    main()
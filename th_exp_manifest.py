@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+"""Build manifest for a folder of dilatometer data files.
+The manifest is a JSON file kept in each data folder:
+    inputs: data file name: {size, mtime, sha256, outputs, depends, metrics}
+where outputs lists the files made from the input and depends holds
+the content hashes of the calibration files (certificate and standard
+polynomial sources) and the settings the outputs were made with. An
+input is stale when its content, its dependencies or any of its outputs
+have changed or gone.
+Processed runs also keep their fit metrics, polynomial coefficients and
+a few metadata fields, so the metrics table and the coefficient store
+(th_exp_coefficients) can be rebuilt without refitting.
+"""
+
+import hashlib
+import json
+import os
+
+manifest_file_name = 'th_exp_manifest.json'
+# Read size for content hashing.
+hash_block = 1 << 20
+
+
+def load_manifest(folder):
+    """Loads the folder's manifest, or an empty one if there is none yet."""
+    try:
+        with open(folder + manifest_file_name, 'r') as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {'inputs': {}}
+
+
+def save_json(path, data, indent=1):
+    """Writes data as JSON with sorted keys through a temporary file, so
+    an interrupted run never leaves a half-written file behind. Used for
+    the manifests and every other JSON file the pipeline keeps.
+    """
+    with open(path + '.tmp', 'w') as json_file:
+        json.dump(data, json_file, indent=indent, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return None
+
+
+def save_manifest(folder, manifest):
+    """Writes the manifest through a temporary file."""
+    return save_json(folder + manifest_file_name, manifest)
+
+
+def file_hash(path):
+    """Returns the sha256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as data_file:
+        for block in iter(lambda: data_file.read(hash_block), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_stamp(path, entry=None):
+    """Returns the size, mtime and content hash of a file.
+    If the manifest entry already has the same size and mtime, its hash
+    is reused instead of reading the file again.
+    """
+    stat = os.stat(path)
+    stamp = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if entry is not None and entry.get('size') == stamp['size'] \
+            and entry.get('mtime') == stamp['mtime']:
+        stamp['sha256'] = entry['sha256']
+    else:
+        stamp['sha256'] = file_hash(path)
+    return stamp
+
+
+def is_stale(folder, entry, stamp, depends):
+    """Checks a manifest entry against a file's current stamp and the
+    current dependency hashes. Missing outputs also make it stale.
+    """
+    if entry is None or entry['sha256'] != stamp['sha256']:
+        return True
+    if entry.get('depends', {}) != depends:
+        return True
+    for name in entry.get('outputs', []):
+        if not os.path.exists(folder + name):
+            return True
+    return False
+
+
+def output_names(manifest):
+    """Returns the set of every output file name in the manifest."""
+    names = set()
+    for entry in manifest['inputs'].values():
+        names.update(entry.get('outputs', []))
+    return names
+
+
+def record_entry(manifest, name, stamp, outputs, depends, metrics=None):
+    """Stores an input's stamp, outputs, dependencies and any fit
+    metrics in the manifest.
+    """
+    entry = dict(stamp)
+    entry['outputs'] = list(outputs)
+    entry['depends'] = dict(depends)
+    if metrics is not None:
+        entry['metrics'] = dict(metrics)
+    manifest['inputs'][name] = entry
+    return None
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+"""Netszch dilatometer export readers shared by the extraction and fitting routines.
+* Finds the '##' column header line and collects the metadata block in one pass.
+* Loads the numeric data block in a single bulk, typed operation.
+Each reader returns a list of (key, value) metadata pairs and a dataframe
+holding every data column named as in the '##' header line. The block
+readers give the same data a fixed number of rows at a time, so a long
+run can be processed without holding all of it.
+"""
+
+import csv
+import itertools
+
+# Kate tells me that the Netszch csv data files are encoded in ISO-8859-15.
+csv_encoding = 'iso_8859_15'
+
+
+def read_header(rows):
+    """Consumes metadata rows from an iterator of split rows, stopping
+    right after the '##' column header line.
+    Returns a list of (key, value) metadata pairs and the column headers.
+    """
+    # In the Netszch data files, the header line for the actual
+    # data starts with a double #, while the metadata lines
+    # start with #, and the data lines start with a space.
+    # Metadata has a ton of whitespace to strip().
+    metadata = []
+    for row in rows:
+        # To cope with the blank line before the '##' line, which comes
+        # through as a row of empty strings from files re-saved by Excel.
+        if not any(row):
+            continue
+        if type(row[0]) == str and row[0].startswith('##'):
+            # Slice off the '##' signal characters and any empty
+            # trailing columns.
+            columns = [row[0][2:]] + list(row[1:])
+            while columns[-1] == '':
+                columns.pop()
+            return metadata, columns
+        # Slice off the '#' signal character.
+        key = row[0][1:].strip()
+        if len(row) > 1 and type(row[1]) == str:
+            metadata.append((key, row[1].strip()))
+        elif len(row) > 1:
+            metadata.append((key, row[1]))
+        else:
+            metadata.append((key, None))
+    raise ValueError('No ## column header line found.')
+
+
+def read_csv_export(path):
+    """Reads a Netszch .csv export.
+    Returns the metadata pairs and a float64 dataframe of the data block.
+    """
+    # The routine leaves the degree symbol as ° and the letter
+    # mu (micro) as µ. There is also a blank line right before
+    # the ## line with a NUL byte, which is fixed via the generator replace().
+    import numpy as np
+    import pandas as pd
+    with open(path, 'r', encoding=csv_encoding, errors='ignore') as raw_file:
+        # csv.reader pulls one line at a time from the generator, so once the
+        # header is found the file is positioned at the first data line.
+        raw_csv = csv.reader((line.replace('\0', '') for line in raw_file),
+                             skipinitialspace=True, delimiter=',')
+        metadata, columns = read_header(raw_csv)
+        df = pd.read_csv(raw_file, header=None, names=columns,
+                         usecols=range(len(columns)), index_col=False,
+                         skipinitialspace=True,
+                         dtype=np.float64, engine='c')
+    return metadata, df
+
+
+def read_xlsx_export(path):
+    """Streams a Netszch .xlsx export row by row.
+    Returns the metadata pairs and a float64 dataframe of the data block.
+    """
+    # The xlsx files cannot be coped with via "csv.reader(... dialect
+    # = 'excel')" and require openpyxl. This routine leaves
+    # both of the disputed characters as �.
+    #
+    # The workbook is opened read-only, so openpyxl parses the sheet
+    # lazily instead of holding every cell object in memory.
+    import numpy as np
+    import openpyxl as xlsx
+    import pandas as pd
+    raw_wb = xlsx.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = raw_wb.active.iter_rows(values_only=True)
+        metadata, columns = read_header(xlsx_metadata_rows(rows))
+        ncols = len(columns)
+        # The data rows go straight into the array: islice drops the
+        # trailing empty cells, and blank rows are skipped.
+        values = itertools.chain.from_iterable(
+            itertools.islice(row, ncols) for row in rows
+            if len(row) > 0 and row[0] is not None)
+        data = np.fromiter(values, dtype=np.float64).reshape(-1, ncols)
+    finally:
+        raw_wb.close()
+    return metadata, pd.DataFrame(data, columns=columns)
+
+
+def xlsx_metadata_rows(rows):
+    """Yields the worksheet rows with the None values of empty cells
+    knocked out, so the blank line comes through as an empty row.
+    Leaves the rest of the rows unread on the underlying iterator.
+    """
+    for row in rows:
+        yield tuple(value for value in row if value is not None)
+
+
+def read_csv_blocks(path, rows):
+    """Reads a Netszch .csv export in blocks of the given number of rows.
+    Yields the metadata pairs with each float64 dataframe block; a run
+    with no data gives one empty block.
+    """
+    import numpy as np
+    import pandas as pd
+    with open(path, 'r', encoding=csv_encoding, errors='ignore') as raw_file:
+        raw_csv = csv.reader((line.replace('\0', '') for line in raw_file),
+                             skipinitialspace=True, delimiter=',')
+        metadata, columns = read_header(raw_csv)
+        blocks = pd.read_csv(raw_file, header=None, names=columns,
+                             usecols=range(len(columns)), index_col=False,
+                             skipinitialspace=True, dtype=np.float64,
+                             engine='c', chunksize=rows)
+        empty = True
+        with blocks:
+            for block in blocks:
+                empty = False
+                yield metadata, block
+        if empty:
+            yield metadata, pd.DataFrame(np.zeros((0, len(columns))),
+                                         columns=columns)
+
+
+def read_xlsx_blocks(path, rows):
+    """Streams a Netszch .xlsx export in blocks of the given number of
+    rows. Yields the metadata pairs with each float64 dataframe block; a
+    run with no data gives one empty block.
+    """
+    import numpy as np
+    import openpyxl as xlsx
+    import pandas as pd
+    raw_wb = xlsx.load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet_rows = raw_wb.active.iter_rows(values_only=True)
+        metadata, columns = read_header(xlsx_metadata_rows(sheet_rows))
+        ncols = len(columns)
+        data_rows = (row for row in sheet_rows
+                     if len(row) > 0 and row[0] is not None)
+        first = True
+        while True:
+            values = itertools.chain.from_iterable(
+                itertools.islice(row, ncols)
+                for row in itertools.islice(data_rows, rows))
+            data = np.fromiter(values, dtype=np.float64).reshape(-1, ncols)
+            if len(data) > 0 or first:
+                yield metadata, pd.DataFrame(data, columns=columns)
+            if len(data) < rows:
+                break
+            first = False
+    finally:
+        raw_wb.close()
+
+
+def read_export(path):
+    """Picks the reader for a data file by its extension.
+    Returns None for files it cannot process.
+    """
+    if path.endswith('.csv'):
+        return read_csv_export(path)
+    elif path.endswith('.xlsx'):
+        return read_xlsx_export(path)
+    else:
+        return None
+
+
+def read_export_blocks(path, rows):
+    """Picks the block reader for a data file by its extension.
+    Returns None for files it cannot process, else a generator of
+    (metadata pairs, dataframe block) of up to rows rows each.
+    """
+    if path.endswith('.csv'):
+        return read_csv_blocks(path, rows)
+    elif path.endswith('.xlsx'):
+        return read_xlsx_blocks(path, rows)
+    else:
+        return None
+
+
+def is_export(path):
+    """Checks whether a data file is a raw Netszch export.
+    Processed .csv outputs lack the leading '#' metadata marker.
+    """
+    if path.endswith('.xlsx'):
+        return True
+    with open(path, 'rb') as raw_file:
+        return raw_file.read(1) == b'#'
@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+
+"""Segmentation of dilatometer runs into heating, cooling and isothermal
+segments.
+A run can hold several temperature program segments, declared in the
+metadata as 'SEG. n' lines such as '1180.0°C/30.0(K/min)/900.0°C', and
+multi-segment exports also number the rows in a 'Segment' column. The
+rows are split:
+* at every change of the instrument's segment number, where there is one,
+* and where the heating rate, measured over a window of rate_window
+  minutes around each row, crosses +-isothermal_rate K/min,
+in vectorized passes over blocks of rows. Pieces shorter than
+min_segment_rows rows (noise around a turning point) are merged into the
+piece before them. Each segment is matched to its declared program
+segment, by the instrument's number or else by order.
+find_segments splits a whole run at once; segment_state, update_segments
+and finish_segments do the same block by block, for runs read in chunks,
+and give the same segments.
+The segments are row ranges:
+    {number, kind, start, stop, declared}
+where kind is 'heating', 'cooling' or 'isothermal' and declared is the
+'SEG.' text, or None.
+"""
+
+import re
+
+# Heating or cooling slower than this, in K/min, counts as isothermal.
+isothermal_rate = 0.5
+# Half width in minutes of the window the heating rate is taken over;
+# wide enough to average out the temperature noise of single rows.
+rate_window = 2.0
+# Pieces shorter than this are merged into the piece before them.
+min_segment_rows = 50
+kinds = {1: 'heating', -1: 'cooling', 0: 'isothermal'}
+
+
+def declared_segments(metadata):
+    """The program segments declared in the metadata, in order.
+    Returns a list of (text, start temperature, rate, end temperature),
+    the numbers being None where they cannot be read.
+    """
+    segments = []
+    for key, value in metadata.items():
+        match = re.match(r'SEG\. *(\d+)', key)
+        if match is None or type(value) != str:
+            continue
+        numbers = re.findall(r'-?\d+(?:\.\d*)?', value)
+        parts = [float(number) for number in numbers[:3]]
+        parts += [None] * (3 - len(parts))
+        segments.append((int(match.group(1)), value, *parts))
+    return [segment[1:] for segment in sorted(segments)]
+
+
+def heating_rate(temps, times, window=rate_window, start=0, stop=None):
+    """Heating rate in K/min at each row: the temperature change across a
+    window of the given half width in minutes, over its duration.
+    Only rows start to stop are rated, against all the rows given.
+    """
+    import numpy as np
+    temps = np.asarray(temps, dtype=np.float64)
+    times = np.asarray(times, dtype=np.float64)
+    rated = times[start:stop]
+    lo = np.searchsorted(times, rated - window, side='left')
+    hi = np.searchsorted(times, rated + window, side='right') - 1
+    span = times[hi] - times[lo]
+    rate = np.zeros_like(rated)
+    good = span > 0
+    rate[good] = (temps[hi] - temps[lo])[good] / span[good]
+    return rate
+
+
+def find_segments(temps, times, labels=None, declared=()):
+    """Splits a run into heating, cooling and isothermal segments.
+    labels is the instrument's segment number of each row, if the export
+    has one, and declared the output of declared_segments.
+    Returns a list of segment dictionaries in row order.
+    """
+    state = segment_state(declared)
+    update_segments(state, temps, times, labels, final=True)
+    return finish_segments(state)[0]
+
+
+def segment_state(declared=()):
+    """Empty state for segmenting a run block by block with
+    update_segments, so the run never has to be held whole. Besides the
+    pieces found so far, it only carries the rows of the last block
+    within two rate windows of its end.
+    """
+    import numpy as np
+    return {'declared': list(declared), 'offset': 0, 'ready': 0,
+            'temps': np.zeros(0), 'times': np.zeros(0),
+            'labels': np.zeros(0, dtype=np.int64), 'last': None,
+            'open': None, 'pieces': [], 'piece_of': []}
+
+
+def update_segments(state, temps=(), times=(), labels=None, final=False):
+    """Adds the next block of rows of a run to the segmentation state.
+    A row is settled once every row within rate_window minutes after it
+    is in, and all the rows are settled when final is set, after the
+    last block. Where the kind or the instrument segment changes, a row
+    starts a new raw piece, which is merged into the piece before it as
+    it closes.
+    Returns the raw piece number of each row settled, in row order;
+    finish_segments maps them to segments.
+    """
+    import numpy as np
+    if labels is None:
+        labels = np.ones(len(temps), dtype=np.int64)
+    temps = np.concatenate((state['temps'],
+                            np.asarray(temps, dtype=np.float64)))
+    times = np.concatenate((state['times'],
+                            np.asarray(times, dtype=np.float64)))
+    labels = np.concatenate((state['labels'],
+                             np.asarray(labels).astype(np.int64)))
+    ready = state['ready']
+    if final or len(times) == 0:
+        stop = len(times)
+    else:
+        # Later rows cannot fall in the window of a row this far back.
+        stop = ready + int(np.searchsorted(times[ready:],
+                                           times[-1] - rate_window,
+                                           side='left'))
+    rate = heating_rate(temps, times, rate_window, ready, stop)
+    sign = np.where(rate > isothermal_rate, 1,
+                    np.where(rate < -isothermal_rate, -1, 0))
+    label = labels[ready:stop]
+    first_row = state['offset'] + ready
+    raw_count = len(state['piece_of']) + (state['open'] is not None)
+    ids = np.zeros(0, dtype=np.int64)
+    if len(sign) > 0:
+        changes = np.empty(len(sign), dtype=bool)
+        changes[1:] = (sign[1:] != sign[:-1]) | (label[1:] != label[:-1])
+        if state['last'] is None:
+            changes[0] = True
+        else:
+            changes[0] = (sign[0], label[0]) != state['last']
+        ids = raw_count - 1 + np.cumsum(changes)
+        base = raw_count - 1 + int(changes[0])
+        counts = np.bincount(3*(ids - base) + sign + 1,
+                             minlength=3*(ids[-1] - base + 1)).reshape(-1, 3)
+        if not changes[0]:
+            state['open']['counts'] = state['open']['counts'] + counts[0]
+            counts = counts[1:]
+        for row, piece_counts in zip(np.flatnonzero(changes).tolist(),
+                                     counts):
+            if state['open'] is not None:
+                close_piece(state, first_row + row)
+            state['open'] = {'start': first_row + row,
+                             'sign': int(sign[row]), 'label': int(label[row]),
+                             'counts': piece_counts}
+        state['last'] = (sign[-1], label[-1])
+    if final and state['open'] is not None:
+        close_piece(state, first_row + len(sign))
+    # Keep the unsettled rows, and the rows the windows of those reach
+    # back to.
+    keep = stop
+    if stop < len(times):
+        keep = int(np.searchsorted(times, times[stop] - rate_window,
+                                   side='left'))
+    state['temps'] = temps[keep:]
+    state['times'] = times[keep:]
+    state['labels'] = labels[keep:]
+    state['offset'] += keep
+    state['ready'] = stop - keep
+    return ids
+
+
+def close_piece(state, stop):
+    """Ends the open raw piece at the given row, merging it into the
+    piece before it if that has the same instrument segment and either
+    the same kind, or this piece is too short to stand alone.
+    """
+    piece = state['open']
+    pieces = state['pieces']
+    piece['stop'] = stop
+    if pieces and piece['label'] == pieces[-1]['label'] and (
+            stop - piece['start'] < min_segment_rows
+            or piece['sign'] == pieces[-1]['sign']):
+        pieces[-1]['stop'] = stop
+        pieces[-1]['counts'] = pieces[-1]['counts'] + piece['counts']
+    else:
+        pieces.append(piece)
+    state['piece_of'].append(len(pieces) - 1)
+    state['open'] = None
+    return None
+
+
+def finish_segments(state):
+    """Turns the pieces of a fully updated segmentation state into
+    segments: a short first piece goes into the second, if they share an
+    instrument segment, and the kind of each is the sign of the median
+    heating rate sign of its rows.
+    Returns the list of segments, and the index in it of the segment
+    each raw piece ended up in.
+    """
+    pieces = [dict(piece) for piece in state['pieces']]
+    piece_of = list(state['piece_of'])
+    if len(pieces) > 1 \
+            and pieces[0]['stop'] - pieces[0]['start'] < min_segment_rows \
+            and pieces[0]['label'] == pieces[1]['label']:
+        pieces[1]['start'] = 0
+        pieces[1]['counts'] = pieces[1]['counts'] + pieces[0]['counts']
+        pieces.pop(0)
+        piece_of = [max(index - 1, 0) for index in piece_of]
+    segments = []
+    for number, piece in enumerate(pieces, 1):
+        segments.append({'number': number,
+                         'kind': kinds[median_sign(piece['counts'])],
+                         'start': piece['start'], 'stop': piece['stop'],
+                         'declared': None, 'label': piece['label']})
+    match_declared(segments, state['declared'])
+    for segment in segments:
+        del segment['label']
+    return segments, piece_of
+
+
+def settled_segments(state):
+    """The segments of the rows settled so far, as finish_segments would
+    give them if the run ended there, for a run still being recorded.
+    The open raw piece is closed on a copy, so the state can still be
+    updated.
+    Returns the list of segments, and the index in it of the segment
+    each raw piece ended up in.
+    """
+    snapshot = dict(state, pieces=[dict(piece) for piece in state['pieces']],
+                    piece_of=list(state['piece_of']))
+    if state['open'] is not None:
+        snapshot['open'] = dict(state['open'])
+        close_piece(snapshot, state['offset'] + state['ready'])
+    return finish_segments(snapshot)
+
+
+def median_sign(counts):
+    """Sign of the median of rows whose heating rate signs -1, 0 and 1
+    occur the given numbers of times, as numpy.median would take it.
+    """
+    rows = int(sum(counts))
+
+    def ranked(position):
+        if position < counts[0]:
+            return -1
+        return 0 if position < counts[0] + counts[1] else 1
+
+    total = ranked((rows - 1) // 2) + ranked(rows // 2)
+    return (total > 0) - (total < 0)
+
+
+def match_declared(segments, declared):
+    """Fills in the declared program segment of each segment: by the
+    instrument's segment number where the export has one, else in order
+    of the heating and cooling segments, if their count matches.
+    """
+    if not declared:
+        return None
+    labelled = len(set(segment['label'] for segment in segments)) > 1
+    moving = [segment for segment in segments
+              if segment['kind'] != 'isothermal']
+    for segment in segments:
+        if labelled and 0 < segment['label'] <= len(declared):
+            segment['declared'] = declared[segment['label'] - 1][0]
+    if not labelled and len(moving) == len(declared):
+        for segment, program in zip(moving, declared):
+            segment['declared'] = program[0]
+    return None
+
+
+def primary_segment(segments, minimum=min_segment_rows):
+    """The first heating segment of at least the minimum number of rows,
+    or failing that the longest segment; None for an empty run.
+    """
+    for segment in segments:
+        if segment['kind'] == 'heating' \
+                and segment['stop'] - segment['start'] >= minimum:
+            return segment
+    if not segments:
+        return None
+    return max(segments, key=lambda segment: segment['stop'] - segment['start'])
+
+
+def segment_numbers(segments):
+    """The segment number of each row of a run."""
+    import numpy as np
+    return np.repeat([segment['number'] for segment in segments],
+                     [segment['stop'] - segment['start']
+                      for segment in segments])
+
+
+def segment_rows(segments, numbers):
+    """Moves the row ranges of the segments onto a column of segment
+    numbers in segment order, such as a run binned onto a grid.
+    Segments with no rows left are dropped.
+    Returns the new list of segments.
+    """
+    import numpy as np
+    numbers = np.asarray(numbers)
+    moved = []
+    for segment in segments:
+        start = int(np.searchsorted(numbers, segment['number'], side='left'))
+        stop = int(np.searchsorted(numbers, segment['number'], side='right'))
+        if stop > start:
+            moved.append(dict(segment, start=start, stop=stop))
+    return moved
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+"""Content-addressed store behind the collected data and the backup.
+Each distinct file content is kept once, named by its sha256 under
+objects/. The collected runs in data/ and the mirror of the raw exports
+in data_backup/ are hardlinks to those objects, so identical runs and
+unchanged files take no more disk. A collected run's object is itself a
+hardlink to the processed file in its sample folder, so collecting
+copies nothing; th_exp_fit replaces its outputs rather than writing
+over them, so the object keeps the content it is named by. The backup
+objects are read-only copies, so the backup stays independent of the
+data tree. The store is a sibling of the data
+root, on the same file system, and keeps an index:
+    sources: source file path: {size, mtime, sha256, data}
+    listing: {day, base, current} collected files by folder, with hashes
+The source stamps mean only new or changed files are hashed and stored,
+and the listings give the daily diffs of what was collected. The data
+hash of a processed run covers its numbers but not its header, so the
+csv and xlsx exports of one run, which differ only in how the header
+spells the degree sign, are found to be duplicates.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+from th_exp_manifest import file_stamp, hash_block, save_json
+from th_exp_columnar import col_ext, read_column_header
+
+store_dir_name = 'data_store'
+index_file_name = 'index.json'
+
+
+def default_store(data_dir):
+    """The store next to the data root."""
+    return os.path.join(os.path.dirname(os.path.abspath(data_dir)),
+                        store_dir_name)
+
+
+def load_index(store):
+    """Loads the store index, or an empty one."""
+    try:
+        with open(os.path.join(store, index_file_name), 'r') as index_file:
+            return json.load(index_file)
+    except FileNotFoundError:
+        return {'sources': {}, 'listing': {}}
+
+
+def save_index(store, index):
+    """Writes the store index through a temporary file."""
+    os.makedirs(store, exist_ok=True)
+    return save_json(os.path.join(store, index_file_name), index)
+
+
+def object_path(store, sha):
+    """Path of the stored copy of a content hash."""
+    return os.path.join(store, 'objects', sha[:2], sha)
+
+
+def store_file(store, index, path, link=False):
+    """Adds a file's content to the store unless it is there already.
+    The file is only hashed if its size or mtime has changed since it
+    was last stored. With link, the object is a hardlink to the file
+    rather than a read-only copy of it. Should the file be written over
+    in place rather than replaced, its linked object no longer holds its
+    hash's content, so it is dropped, and any other source with that
+    content is linked again on the next pass.
+    Returns the content hash.
+    """
+    old = index['sources'].get(path)
+    stamp = file_stamp(path, old)
+    sha = stamp['sha256']
+    if old is not None and old['sha256'] != sha:
+        old_obj = object_path(store, old['sha256'])
+        if os.path.exists(old_obj) and os.path.samefile(path, old_obj):
+            os.remove(old_obj)
+    elif old is not None and 'data' in old:
+        stamp['data'] = old['data']
+    obj = object_path(store, sha)
+    if not os.path.exists(obj):
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        if os.path.lexists(obj + '.tmp'):
+            os.remove(obj + '.tmp')
+        linked = False
+        if link:
+            try:
+                os.link(path, obj + '.tmp')
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            shutil.copy2(path, obj + '.tmp')
+            # Read-only, since every link to it shares the one copy.
+            os.chmod(obj + '.tmp', stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(obj + '.tmp', obj)
+    index['sources'][path] = stamp
+    return sha
+
+
+def data_hash(index, path):
+    """Returns the sha256 of the data of a stored processed run: the
+    float64 columns of a columnar file, or the lines after the header of
+    a csv file. The hash is kept with the source stamp, so it is only
+    worked out again when the file changes.
+    """
+    source = index['sources'][path]
+    if 'data' not in source:
+        if path.endswith(col_ext):
+            offset = read_column_header(path)[1]
+        else:
+            with open(path, 'rb') as data_file:
+                offset = len(data_file.readline())
+        digest = hashlib.sha256()
+        with open(path, 'rb') as data_file:
+            data_file.seek(offset)
+            for block in iter(lambda: data_file.read(hash_block), b''):
+                digest.update(block)
+        source['data'] = digest.hexdigest()
+    return source['data']
+
+
+def link_object(store, sha, target):
+    """Points target at the stored copy of a content hash, by a hardlink
+    where the file system allows it and a copy where it does not.
+    Returns True if the target was changed.
+    """
+    obj = object_path(store, sha)
+    if os.path.exists(target) and os.path.samefile(target, obj):
+        return False
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    temp_name = target + '.tmp'
+    if os.path.lexists(temp_name):
+        os.remove(temp_name)
+    try:
+        os.link(obj, temp_name)
+    except OSError:
+        shutil.copy2(obj, temp_name)
+    os.replace(temp_name, target)
+    return True
+
+
+def duplicate_files(hashes):
+    """Groups the files of a listing by content.
+    Takes a dictionary of file name: hash by folder, such as the data
+    hashes of the collected runs.
+    Returns the lists of paths sharing a hash, for each repeated hash.
+    """
+    by_hash = {}
+    for folder in sorted(hashes):
+        for name in sorted(hashes[folder]):
+            by_hash.setdefault(hashes[folder][name], []).append(
+                os.path.join(folder, name))
+    return [paths for paths in by_hash.values() if len(paths) > 1]
+
+
+def listing_diff(old, new):
+    """Compares two listings of file name: hash by folder.
+    Returns the added, removed and changed file names by folder.
+    """
+    diff = {'added': {}, 'removed': {}, 'changed': {}}
+    for folder in sorted(set(old) | set(new)):
+        old_files = old.get(folder, {})
+        new_files = new.get(folder, {})
+        names = {'added': sorted(set(new_files) - set(old_files)),
+                 'removed': sorted(set(old_files) - set(new_files)),
+                 'changed': sorted(name for name in new_files
+                                   if name in old_files
+                                   and new_files[name] != old_files[name])}
+        for key in diff:
+            if names[key]:
+                diff[key][folder] = names[key]
+    return diff
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+"""Per-stage telemetry for the fitting pipeline.
+When enabled, each stage records its wall time, rows per second and
+peak memory (traced by tracemalloc) for each file, as one JSON line in a
+log kept in the data folder next to the manifest and th_exp_data.dat:
+    {run, stage, folder, file, seconds, rows, rows_per_sec, peak_mb, pid}
+Records are written as each stage ends, so the worker processes can
+append to the same log; the run id picks out the records of one run for
+the summary. Stages may nest: a stage's peak includes its inner stages.
+Tracing memory slows allocation heavy stages such as to_csv two or three
+times, so it can be left off for timings alone; peak_mb is then None.
+When disabled, stage() hands back a shared do-nothing context, so the
+instrumented code runs at practically full speed.
+"""
+
+import contextlib
+import json
+import os
+import time
+
+log_file_name = 'th_exp_telemetry.jsonl'
+# The run id is passed through the environment, so worker processes
+# pick it up however they are started.
+run_variable = 'TH_EXP_TELEMETRY_RUN'
+# Set when peak memory is traced as well
+memory_variable = 'TH_EXP_TELEMETRY_MEMORY'
+# Stand-in for the record of a disabled stage.
+null_stage = contextlib.nullcontext({})
+# Open stages of this process, innermost last.
+open_stages = []
+
+
+def enable(run=None, memory=True):
+    """Turns telemetry on for this process and any it starts, with or
+    without memory tracing. Returns the run id.
+    """
+    if run is None:
+        run = time.strftime('%Y%m%dT%H%M%S') + '-' + str(os.getpid())
+    os.environ[run_variable] = run
+    if memory:
+        os.environ[memory_variable] = '1'
+    else:
+        os.environ.pop(memory_variable, None)
+    return run
+
+
+def enabled():
+    """Returns the current run id, or None if telemetry is off."""
+    return os.environ.get(run_variable)
+
+
+def stage(name, folder, file_name=None):
+    """Context manager timing one stage of one file. The block may set
+    'rows' in the record it gets, for the rows per second.
+    """
+    if run_variable not in os.environ:
+        return null_stage
+    if memory_variable not in os.environ:
+        return clocked_stage(name, folder, file_name)
+    return timed_stage(name, folder, file_name)
+
+
+@contextlib.contextmanager
+def clocked_stage(name, folder, file_name):
+    """Times the block and logs the record, without memory tracing."""
+    record = {'rows': None}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        log_stage(name, folder, file_name, time.perf_counter() - start,
+                  record['rows'], None)
+
+
+@contextlib.contextmanager
+def timed_stage(name, folder, file_name):
+    """Times the block, tracks its peak memory and logs the record."""
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if open_stages:
+        # Keep the enclosing stage's peak so far before it is reset.
+        parent = open_stages[-1]
+        parent['peak'] = max(parent['peak'], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    record = {'rows': None}
+    state = {'base': tracemalloc.get_traced_memory()[0], 'peak': 0}
+    open_stages.append(state)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        open_stages.pop()
+        peak = max(state['peak'], tracemalloc.get_traced_memory()[1])
+        if open_stages:
+            open_stages[-1]['peak'] = max(open_stages[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        log_stage(name, folder, file_name, seconds, record['rows'],
+                  max(peak - state['base'], 0) / 2**20)
+
+
+def log_stage(name, folder, file_name, seconds, rows, peak_mb):
+    """Writes the record of a finished stage."""
+    write_record(folder, {
+        'run': enabled(), 'stage': name, 'folder': folder,
+        'file': file_name, 'seconds': seconds, 'rows': rows,
+        'rows_per_sec': rows / seconds if rows and seconds > 0 else None,
+        'peak_mb': peak_mb, 'pid': os.getpid()})
+    return None
+
+
+def write_record(folder, record):
+    """Appends one record to the folder's log in a single write."""
+    with open(folder + log_file_name, 'a') as log_file:
+        log_file.write(json.dumps(record) + '\n')
+    return None
+
+
+def read_records(folders, run):
+    """Reads the records of one run from the folders' logs."""
+    records = []
+    for folder in folders:
+        try:
+            with open(folder + log_file_name, 'r') as log_file:
+                for line in log_file:
+                    record = json.loads(line)
+                    if record['run'] == run:
+                        records.append(record)
+        except FileNotFoundError:
+            pass
+    return records
+
+
+def summary(records, slowest=5):
+    """Text table of the time, rows per second and peak memory of each
+    stage over all files, then the slowest files.
+    """
+    stages = {}
+    for record in records:
+        total = stages.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0,
+                                                    'rows': 0, 'peak_mb': 0.0})
+        total['calls'] += 1
+        total['seconds'] += record['seconds']
+        total['rows'] += record['rows'] or 0
+        if record['peak_mb'] is not None:
+            total['peak_mb'] = max(total['peak_mb'], record['peak_mb'])
+        else:
+            total['peak_mb'] = float('nan')
+    lines = [f"{'stage':<12} {'calls':>6} {'seconds':>9} {'rows/sec':>11} "
+             f"{'peak MB':>8}"]
+    for name, total in stages.items():
+        rate = total['rows'] / total['seconds'] \
+            if total['rows'] and total['seconds'] > 0 else float('nan')
+        lines.append(f"{name:<12} {total['calls']:>6} {total['seconds']:>9.3f} "
+                     f"{rate:>11.0f} {total['peak_mb']:>8.1f}")
+    files = [r for r in records if r['stage'] == 'process']
+    files.sort(key=lambda r: r['seconds'], reverse=True)
+    if files:
+        lines.append('Slowest files:')
+        for record in files[:slowest]:
+            lines.append(f"  {record['folder'] + record['file']:<60} "
+                         f"{record['seconds']:>8.3f} s")
+    return '\n'.join(lines)
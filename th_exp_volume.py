@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+"""Volume alpha of each sample from runs along orthogonal orientations.
+To first order the volume alpha is the sum of the linear alphas along
+three orthogonal directions. For each sample with a full orientation set:
+* the runs of each orientation are taken from the coefficient store
+  (th_exp_coefficients), a run exported both as csv and as a workbook
+  counting once, and several runs of one orientation being averaged
+  where they cover a temperature, each run's weight tapering off over
+  blend_width kelvin towards the ends of its range, so the mean does not
+  step where a run ends,
+* every run of every sample that needs it is evaluated on one shared
+  temperature grid in a single vectorized call,
+* the orientations are summed, on the temperatures each of them covers,
+* runs bootstrapped with th_exp_fit --bootstrap carry their coefficient
+  covariance, and the variances add up to a band on the volume alpha.
+Results are cached in a JSON file in the data root, keyed by a hash of
+the input runs' export hashes and fits, so a new run only recomputes the
+samples it belongs to:
+    sample: {key, runs, temps, alpha, lower, upper, changes}
+where changes are the temperatures at which the runs averaged change.
+th_exp_fit updates the cache after each folder it processes.
+"""
+
+import argparse
+import hashlib
+import json
+from th_exp_coefficients import load_store, select_runs, evaluate, \
+    alpha_variance, default_model
+from th_exp_manifest import save_json
+from data_fitting import bootstrap_level
+
+volume_file_name = 'volume_alpha.json'
+# Step in kelvin of the shared temperature grid
+volume_step = 1.0
+# Kelvin over which a run's weight in its orientation's mean falls off
+# towards the ends of its fitted range
+blend_width = 25.0
+# Orientation sets that cannot be read from the run names, as
+# (orientation, run) by sample; from the pairings in data-eval.txt.
+# Samples with runs named 100, 010 and 001 are paired automatically.
+volume_sets = {'byto': [('000', 'sA1r2'), ('000', 'sB1r1'), ('000', 'sCr1')],
+               'moon': [('000', 's1r1'), ('000', 's2r1'), ('000', 's3r1')]}
+named_orientations = ('100', '010', '001')
+
+
+def distinct_runs(store, keys):
+    """Drops the second export of a run exported both as csv ('c') and as
+    a workbook ('x'), keeping the 'c' file as plot_all.run_index does,
+    so one measurement is not averaged with itself. Two files are the
+    same run when they share the measurement date and point count, or
+    the run name where the date is missing.
+    Returns the remaining keys in sorted order.
+    """
+    runs = {}
+    for key in keys:
+        record = store['runs'][key]
+        date = record.get('metadata', {}).get('date')
+        run = (date, record['points']) if date else record['run']
+        filetype = record['file'].split('.')[-2][-1]
+        if run not in runs or (filetype, key) < runs[run]:
+            runs[run] = (filetype, key)
+    return sorted(key for _, key in runs.values())
+
+
+def orientation_sets(store, sets=volume_sets):
+    """Store keys of each orientation of each sample with a full set,
+    one per measured run.
+    Returns a dictionary by sample of three lists of keys.
+    """
+    groups = {}
+    for sample, members in sets.items():
+        groups[sample] = [select_runs(store, sample, orientation, run)
+                          for orientation, run in members]
+    samples = set(record['sample'] for record in store['runs'].values())
+    for sample in sorted(samples - set(sets)):
+        groups[sample] = [select_runs(store, sample, orientation)
+                          for orientation in named_orientations]
+    return {sample: [distinct_runs(store, keys) for keys in orientations]
+            for sample, orientations in groups.items() if all(orientations)}
+
+
+def set_key(store, keys, model=default_model, step=volume_step,
+            blend=blend_width):
+    """Hash of everything a sample's volume alpha depends on: the export
+    hash and fit of each run, the model, the grid step and the blend
+    width.
+    """
+    inputs = [[[store['runs'][key]['sha256'],
+                store['runs'][key]['fits'][model]] for key in orientation]
+              for orientation in keys]
+    text = json.dumps([inputs, model, step, blend], sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def volume_alpha(store, groups, model=default_model, step=volume_step,
+                 level=bootstrap_level, blend=blend_width):
+    """Volume alpha of each sample's orientation set on the grid of
+    multiples of step, trimmed to the temperatures every orientation
+    covers.
+    All the runs are evaluated together. Each orientation is the
+    weighted mean of its runs that cover a temperature, through a
+    membership matrix of orientations by runs, and the orientations are
+    summed. Where another run of the orientation goes on past the end of
+    a run, the run's weight falls from one, blend kelvin inside its
+    range, to nearly zero at that end, as the square of the distance,
+    so the run blends out of the mean rather than stepping it. The band is left out (None) unless
+    every run has a coefficient covariance.
+    Returns a dictionary by sample of {temps, alpha, lower, upper,
+    changes}, changes being the temperatures from which the set of runs
+    averaged differs from the temperature before.
+    """
+    import numpy as np
+    from statistics import NormalDist
+    keys = sorted(set(key for orientations in groups.values()
+                      for orientation in orientations for key in orientation))
+    if not keys:
+        return {}
+    column = {key: i for i, key in enumerate(keys)}
+    domains = np.array([store['runs'][key]['fits'][model]['domain']
+                        for key in keys])
+    temps = np.arange(np.ceil(domains[:, 0].min()/step),
+                      np.floor(domains[:, 1].max()/step) + 1) * step
+    alphas = evaluate(store, keys, temps, 'alpha', model)
+    variances = alpha_variance(store, keys, temps, model)
+    samples = sorted(groups)
+    rows = [(i, orientation) for i, sample in enumerate(samples)
+            for orientation in groups[sample]]
+    members = np.zeros((len(rows), len(keys)))
+    sums = np.zeros((len(samples), len(rows)))
+    for j, (i, orientation) in enumerate(rows):
+        sums[i, j] = 1.0
+        for key in orientation:
+            members[j, column[key]] = 1.0
+    # Each orientation averages the runs that cover a temperature, and a
+    # temperature no run of some orientation covers is dropped, rather
+    # than summing fewer than three orientations.
+    measured = ~np.isnan(alphas)
+    # Only the ends of a run that another run of its orientation reaches
+    # more than a grid step past are blended.
+    reach = domains.copy()
+    for j in range(len(rows)):
+        runs = members[j] > 0
+        reach[runs] = (domains[runs, 0].min(), domains[runs, 1].max())
+    inside = np.minimum(
+        np.where(domains[:, :1] > reach[:, :1] + step,
+                 temps[None, :] - domains[:, :1], np.inf),
+        np.where(domains[:, 1:] < reach[:, 1:] - step,
+                 domains[:, 1:] - temps[None, :], np.inf))
+    # The weight is kept above zero, so a run alone still counts at the
+    # very ends of its range.
+    weights = np.where(measured,
+                       np.clip(inside/blend, 1e-6, 1.0)**2, 0.0)
+    totals = members @ weights
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = (members @ (weights*np.nan_to_num(alphas))) / totals
+        mean_variances = (members @ (weights**2*np.nan_to_num(variances))) \
+            / totals**2
+    covered = (sums @ (totals == 0)) == 0
+    volume = sums @ np.nan_to_num(means)
+    used = (sums @ members) > 0
+    banded = ~(used & np.isnan(variances).all(axis=1)).any(axis=1)
+    # Rows measured at a temperature and not the one before, or the
+    # other way round, by sample.
+    changed = (used.astype(np.float64)
+               @ (measured[:, 1:] != measured[:, :-1])) > 0
+    spread = np.sqrt(sums @ np.nan_to_num(mean_variances))
+    spread *= NormalDist().inv_cdf(0.5 + level/2)
+    results = {}
+    for i, sample in enumerate(samples):
+        keep = covered[i]
+        changes = changed[i] & keep[1:] & keep[:-1]
+        result = {'temps': temps[keep].tolist(),
+                  'alpha': volume[i, keep].tolist(),
+                  'lower': None, 'upper': None,
+                  'changes': temps[1:][changes].tolist()}
+        if banded[i]:
+            result['lower'] = (volume[i, keep] - spread[i, keep]).tolist()
+            result['upper'] = (volume[i, keep] + spread[i, keep]).tolist()
+        results[sample] = result
+    return results
+
+
+def load_volumes(root):
+    """Loads the cached volume alphas from the data root, or none."""
+    try:
+        with open(root + volume_file_name, 'r') as volume_file:
+            return json.load(volume_file)
+    except FileNotFoundError:
+        return {}
+
+
+def update_volumes(root, store=None, model=default_model, step=volume_step,
+                   force=False):
+    """Recomputes the volume alpha of the samples whose runs changed,
+    all in one volume_alpha call, and rewrites the cache if any did.
+    Returns the cache and a list of the samples recomputed.
+    """
+    if store is None:
+        store = load_store(root)
+    cache = load_volumes(root)
+    groups = orientation_sets(store)
+    keys = {sample: set_key(store, groups[sample], model, step)
+            for sample in groups}
+    stale = {sample: groups[sample] for sample in groups
+             if force or cache.get(sample, {}).get('key') != keys[sample]}
+    gone = [sample for sample in cache if sample not in groups]
+    if not stale and not gone:
+        return cache, []
+    for sample in gone:
+        del cache[sample]
+    for sample, result in volume_alpha(store, stale, model, step).items():
+        result['key'] = keys[sample]
+        result['runs'] = stale[sample]
+        cache[sample] = result
+    # The curves are long, so the cache is written without indentation.
+    save_json(root + volume_file_name, cache, indent=None)
+    return cache, sorted(stale)
+
+
+def main(argv=None):
+    """Command line interface; argv defaults to sys.argv[1:]."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', nargs='?', default='data/',
+                        help='root of the data tree (default data/)')
+    parser.add_argument('--step', type=float, default=volume_step,
+                        help='temperature grid step in kelvin (default %(default)s)')
+    parser.add_argument('--model', default=default_model,
+                        help='polynomial model (default %(default)s)')
+    parser.add_argument('--force', action='store_true',
+                        help='recompute every sample, cached or not')
+    args = parser.parse_args(argv)
+    root = args.root
+    if not root.endswith('/'):
+        root = root + '/'
+    cache, recomputed = update_volumes(root, model=args.model, step=args.step,
+                                       force=args.force)
+    for sample, result in sorted(cache.items()):
+        status = 'recomputed' if sample in recomputed else 'cached'
+        runs = ' + '.join(', '.join(orientation)
+                          for orientation in result['runs'])
+        if result['temps']:
+            span = f"{result['temps'][0]:.0f} to {result['temps'][-1]:.0f} C"
+        else:
+            span = 'no common temperatures'
+        band = ', with band' if result['lower'] is not None else ''
+        if result.get('changes'):
+            changes = ', '.join(f'{temp:.0f}' for temp in result['changes'])
+            band += f', runs change at {changes} C'
+        print(f'{sample}: {span}{band} ({status})\n    {runs}')
+    return None
+
+
+if __name__ == '__main__':
+    main()
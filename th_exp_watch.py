@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+"""Watch mode for the Netszch dilatometer data tree.
+* It polls the leaf folders of the data tree for new or rewritten
+  .csv and .xlsx exports,
+* waits until each file has stopped changing, since exports are written
+  in pieces,
+* then pushes its folder through th_exp_fit (parse, correct, fit) and
+  collect_data, through a bounded queue of folders and a persistent
+  pool of worker processes.
+A file that fails to process is reported and left out of its folder's
+manifest, so it is tried again when it next changes. Stop with Ctrl-C.
+The processing options are those of th_exp_fit, and should be the ones
+the tree was last processed with.
+"""
+
+import argparse
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from th_exp_fit import leaf_folders, process_folders, record_update, \
+    output_formats, add_processing_args, processing_settings
+from th_exp_manifest import load_manifest, output_names
+from data_fitting import local_window
+from collect_data import collect
+
+# Seconds between scans of the data tree
+poll_interval = 2.0
+# Seconds a file must stay unchanged before its folder is processed
+settle_time = 5.0
+# Most folders waiting to be processed at once
+queue_size = 8
+
+
+def scan(root):
+    """Stats the data files in the leaf folders of the tree, skipping the
+    outputs already listed in each folder's manifest.
+    Returns a dictionary of (size, mtime) by (folder, file name).
+    """
+    stats = {}
+    for folder in leaf_folders(root):
+        outputs = output_names(load_manifest(folder))
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name in outputs or not entry.is_file():
+                    continue
+                if entry.name.endswith('.csv') or entry.name.endswith('.xlsx'):
+                    stat = entry.stat()
+                    stats[(folder, entry.name)] = (stat.st_size,
+                                                   stat.st_mtime_ns)
+    return stats
+
+
+def process_queue(ready, queued, lock, root, pool, formats, settings):
+    """Takes folders off the queue and processes and collects them until
+    it gets None. settings holds the window, bootstrap, method, grid and
+    chunk arguments of process_folders. Errors are reported and never
+    stop the loop.
+    """
+    while True:
+        folder = ready.get()
+        if folder is None:
+            ready.task_done()
+            return None
+        # Changes that land from here on queue the folder again.
+        with lock:
+            queued.discard(folder)
+        try:
+            processed = process_folders([folder], formats=formats, pool=pool,
+                                        **settings)
+            for processed_folder, update in processed.items():
+                record_update(processed_folder, **update)
+            if processed:
+                collect(os.path.normpath(root))
+        except Exception as error:
+            print('Failed to process', folder+':', repr(error))
+        finally:
+            ready.task_done()
+
+
+def watch(root, workers=None, formats=output_formats, interval=poll_interval,
+          settle=settle_time, size=queue_size, window=local_window,
+          bootstrap=0, method='residuals', grid=None, chunk=None):
+    """Catches up on every folder of the tree, then polls it for changes
+    and queues each folder once all its changed files have settled.
+    The window, bootstrap, method, grid and chunk settings are passed on
+    to process_folders; they are part of each run's manifest entry, so
+    they must match the ones the tree was processed with, or every run
+    is processed again.
+    """
+    settings = {'window': window, 'bootstrap': bootstrap, 'method': method,
+                'grid': grid, 'chunk': chunk}
+    ready = queue.Queue(maxsize=size)
+    queued = set()
+    lock = threading.Lock()
+
+    def enqueue(folder):
+        with lock:
+            if folder in queued:
+                return None
+            queued.add(folder)
+        # Blocks while the queue is full, which holds off the scans.
+        ready.put(folder)
+        return None
+
+    # Ctrl-C goes to the whole process group; the workers leave it to
+    # the main process, which finishes the folders in progress.
+    with ProcessPoolExecutor(max_workers=workers, initializer=signal.signal,
+                             initargs=(signal.SIGINT, signal.SIG_IGN)) as pool:
+        consumer = threading.Thread(target=process_queue, daemon=True,
+                                    args=(ready, queued, lock, root, pool,
+                                          formats, settings))
+        consumer.start()
+        known = scan(root)
+        for folder in leaf_folders(root):
+            enqueue(folder)
+        changed = {}
+        try:
+            while True:
+                time.sleep(interval)
+                now = time.monotonic()
+                stats = scan(root)
+                for key, stat in stats.items():
+                    if known.get(key) != stat:
+                        known[key] = stat
+                        changed[key] = now
+                for key in list(changed):
+                    if key not in stats:
+                        del changed[key]
+                        known.pop(key, None)
+                unsettled = set(folder for (folder, name), when
+                                in changed.items() if now - when < settle)
+                for (folder, name) in list(changed):
+                    if folder not in unsettled:
+                        del changed[(folder, name)]
+                        enqueue(folder)
+        except KeyboardInterrupt:
+            print('Stopping after the folders in progress.')
+        ready.put(None)
+        consumer.join()
+    return None
+
+
+def main(argv=None):
+    """Command line interface; argv defaults to sys.argv[1:]."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', nargs='?', default='data/',
+                        help='root of the data tree (default data/)')
+    add_processing_args(parser)
+    parser.add_argument('--interval', type=float, default=poll_interval,
+                        help='seconds between scans (default %(default)s)')
+    parser.add_argument('--settle', type=float, default=settle_time,
+                        help='seconds a file must stay unchanged (default %(default)s)')
+    parser.add_argument('--queue', type=int, default=queue_size,
+                        help='most folders waiting at once (default %(default)s)')
+    args = parser.parse_args(argv)
+    settings = processing_settings(parser, args)
+    root = args.root
+    if not root.endswith('/'):
+        root = root + '/'
+    watch(root, args.workers, args.format, args.interval, args.settle,
+          args.queue, **settings)
+    return None
+
+
+if __name__ == '__main__':
+    main()